@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 import argparse
-import fileinput
+import base64
+import collections
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import gzip
+import queue
+import random
 import re
+import shutil
 import subprocess
 import sys
 import os
+import tempfile
 import textwrap
 import json
-import platform
+import urllib.parse
+import threading
+import time
 import traceback
-from functools import cmp_to_key
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import wraps
 
 # ===================================================================================
 # Begin editable globals.
@@ -54,6 +67,12 @@ react_app_subdir = 'cross-platform/react-app'
 token_server_subdir = 'cross-platform/token-server'
 # The scope for iTwin npm packages.
 itwin_scope = '@itwin'
+# The package.json maps whose entries are updated to the new versions.
+package_json_dependency_maps = [
+    "dependencies",
+    "devDependencies",
+    "peerDependencies",
+]
 # The npm packages with an @itwin/ prefix that aren't part of itwinjs-core.
 itwin_non_core_packages = [
     "eslint-plugin",
@@ -93,8 +112,16 @@ itwin_non_core_packages.extend(presentation_packages)
 itwin_version_package = '@itwin/core-common'
 # The package whose dependencies determine the current add-on version.
 native_version_package = '@itwin/core-backend'
+# The dependency of native_version_package that holds the add-on version.
+native_version_dependency = '@bentley/imodeljs-native'
+# The npm registry to query for package versions. Can be overridden with --registry or the
+# npm_config_registry environment variable.
+npm_registry = 'https://registry.npmjs.org/'
 # The branch this script is running in
 git_branch = 'main'
+# The URL that the bootstrap command clones the repositories from (as <URL>/<repository>.git). This
+# can also be a local directory of bare repositories.
+git_base_url = 'https://github.com/iTwin'
 # The names of the iOS sample apps
 ios_sample_names = [
     'CameraSample',
@@ -112,31 +139,75 @@ android_sample_names = [
 react_native_sample_names = [
     'iTwinRNStarter',
 ]
+# The maximum number of npm registry and git remote lookups to run at the same time.
+max_lookup_workers = 8
+# The maximum number of files to rewrite at the same time.
+max_rewrite_workers = 8
+# The maximum number of npm installs to run at the same time.
+max_npm_install_jobs = 4
+# The maximum number of release, lint, and push steps to run at the same time in the stage commands.
+max_stage_jobs = 4
+# The number of lines of output kept for each directory by 'do --jobs' (older lines are dropped).
+do_max_output_lines = 200
+# The number of slowest steps to show at the end of a run with --trace.
+trace_summary_count = 15
+# How long (in seconds) each kind of lookup stays in the on-disk lookup cache.
+lookup_cache_ttls = {
+    # New releases can be published at any time.
+    'latest_version': 15 * 60,
+    # The dependencies of a published package version never change.
+    'native_version': 7 * 24 * 60 * 60,
+    # Release tags are not expected to move once pushed.
+    'remote_commit_id': 24 * 60 * 60,
+    # Keyed on the path and modification time of the tool, so these only change when it is replaced.
+    'tool_version': 30 * 24 * 60 * 60,
+}
+# The maximum number of entries to keep in the on-disk lookup cache.
+lookup_cache_max_entries = 1000
+# How npm_build_dir puts the relativeDependencies of a package into its node_modules: 'hardlink'
+# (which falls back to copying between file systems), 'copy', or 'relative-deps' (npx relative-deps).
+local_link_mode = 'hardlink'
+# The packages that the watch command waits for (at the new release version) before running each
+# stage.
+watch_stage_packages = {
+    'stage2': ['@itwin/mobile-sdk-core'],
+    'stage3': ['@itwin/mobile-sdk-core', '@itwin/mobile-ui-react'],
+}
+# The watch command polls the npm registry every watch_poll_interval seconds at first, backing
+# off to every watch_max_poll_interval seconds, and gives up after watch_deadline_minutes.
+watch_poll_interval = 15
+watch_max_poll_interval = 300
+watch_deadline_minutes = 120
+# The number of CPUs to allow for each iTwin version that the matrix command tests at the same time
+# (each one runs several npm installs and builds of its own). Used when --jobs isn't specified.
+matrix_cpus_per_job = 2
 
 # ===================================================================================
 # End editable globals.
 # ===================================================================================
 
 class MobileSdkDirs:
+    # The relative paths to the iTwin Mobile SDK repository directories.
+    # Since these are directly tied to member properties on this class, they cannot
+    # be in the editable globals section above.
+    relative_dirs = [
+        'mobile-sdk-ios',
+        'mobile-sdk-android',
+        'mobile-sdk-core',
+        'mobile-ui-react',
+        'mobile-samples',
+    ]
+
     def __init__(self, args):
         if args.parent_dir:
             parent_dir = os.path.realpath(args.parent_dir)
         else:
             parent_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
-        # The relative paths to the iTwin Mobile SDK repository directories.
-        # Since these are directly tied to member properties on this class, they cannot
-        # be in the editable globals section above.
-        relative_dirs = [
-            'mobile-sdk-ios',
-            'mobile-sdk-android',
-            'mobile-sdk-core',
-            'mobile-ui-react',
-            'mobile-samples',
-        ]
         def build_dir(dir_name):
             return os.path.realpath(os.path.join(parent_dir, dir_name))
+        self.parent_dir = parent_dir
         self.dirs = []
-        for relative_dir in relative_dirs:
+        for relative_dir in self.relative_dirs:
             self.dirs.append(build_dir(relative_dir))
         self.sdk_ios = self.dirs[0]
         self.sdk_android = self.dirs[1]
@@ -147,12 +218,381 @@ class MobileSdkDirs:
     def __iter__(self):
         return iter(self.dirs)
 
+# Records timed spans for subprocesses, registry lookups, file rewrites and stage tasks, and saves
+# them in the Chrome trace event format (viewable in chrome://tracing or Perfetto).
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.events = []
+        self.thread_names = {}
+
+    def add_span(self, name, category, start, end, span_args):
+        thread = threading.current_thread()
+        with self.lock:
+            self.thread_names[thread.ident] = thread.name
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': round((start - self.start) * 1000000),
+                'dur': round((end - start) * 1000000),
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': span_args,
+            })
+
+    def save(self, filename):
+        with self.lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}} for (tid, name) in self.thread_names.items()]
+            events.extend(self.events)
+        write_file_atomically(filename, json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}).encode('UTF-8'))
+
+    def print_summary(self, count):
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['dur'], reverse=True)[:count]
+        print(f'Slowest {len(events)} traced steps:')
+        for event in events:
+            print(f"  {event['dur'] / 1000000:8.2f}s  {event['cat']:<10}  {event['name']}")
+
+# Replaced in __main__ when --trace is specified.
+tracer = None
+
+# Removes the GitHub token (which is embedded in the push URLs) from traced values.
+def redact(value):
+    token = os.getenv('GH_TOKEN')
+    if not token:
+        return value
+    if isinstance(value, str):
+        return value.replace(token, '***')
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+# Records a span for the body of the with statement when tracing. The yielded dict holds the span's
+# args, and can be updated inside the body (for example, with an exit code).
+@contextlib.contextmanager
+def trace_span(name, category, **span_args):
+    if tracer is None:
+        yield span_args
+        return
+    start = time.perf_counter()
+    try:
+        yield span_args
+    except BaseException as error:
+        span_args.setdefault('error', str(error))
+        raise
+    finally:
+        tracer.add_span(redact(name), category, start, time.perf_counter(), {key: redact(value) for (key, value) in span_args.items()})
+
+@contextlib.contextmanager
+def trace_subprocess(command, cwd = None):
+    cwd = cwd or os.getcwd()
+    with trace_span(f"{os.path.basename(cwd)}: {' '.join(command)}", 'subprocess', command=command, cwd=cwd) as span:
+        try:
+            yield span
+        except subprocess.CalledProcessError as error:
+            span['exit_code'] = error.returncode
+            raise
+        span.setdefault('exit_code', 0)
+
+# Decorator for the modify_* functions, which all take args and a file or directory path.
+def traced_rewrite(function):
+    @wraps(function)
+    def wrapper(args, path):
+        with trace_span(f'{function.__name__} {path}', 'rewrite', path=path):
+            return function(args, path)
+    return wrapper
+
+# Cache for registry and git remote lookups that persists across invocations. Each entry has its
+# own expiration time, and the least recently used entries are evicted once there are more than
+# lookup_cache_max_entries of them. When filename is None, nothing is read from or written to disk.
+class LookupCache:
+    def __init__(self, filename = None, refresh = False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        if filename and not refresh and os.path.exists(filename):
+            try:
+                with open(filename, encoding='UTF-8') as file:
+                    entries = json.load(file)
+                if isinstance(entries, dict):
+                    self.entries = entries
+            except (OSError, ValueError):
+                # A corrupt cache is simply treated as empty.
+                pass
+        if refresh:
+            self.save()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            now = time.time()
+            if entry['expires'] < now:
+                del self.entries[key]
+                return None
+            entry['accessed'] = now
+            return entry['value']
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            now = time.time()
+            self.entries[key] = {'value': value, 'expires': now + ttl, 'accessed': now}
+            if len(self.entries) > lookup_cache_max_entries:
+                by_access = sorted(self.entries, key=lambda key: self.entries[key]['accessed'])
+                for key in by_access[:len(self.entries) - lookup_cache_max_entries]:
+                    del self.entries[key]
+            self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = f'{self.filename}.{os.getpid()}.tmp'
+        with open(temp_filename, 'w', encoding='UTF-8') as file:
+            json.dump(self.entries, file)
+        os.replace(temp_filename, self.filename)
+
+def get_lookup_cache_filename():
+    cache_dir = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'itwin-mobile-sdk', 'newVersion-lookups.json')
+
+# Replaced in __main__ with a cache that is backed by a file.
+lookup_cache = LookupCache()
+
+def cached_lookup(kind, key, lookup):
+    cache_key = f'{kind}:{key}'
+    with trace_span(f'{kind} {key}', 'lookup') as span:
+        value = lookup_cache.get(cache_key)
+        span['cached'] = value is not None
+        if value is None:
+            value = lookup()
+            if value is not None:
+                lookup_cache.set(cache_key, value, lookup_cache_ttls[kind])
+        span['value'] = value
+    return value
+
+# Reads the npm configuration the way npm view would see it: the global npmrc, the user .npmrc, and
+# the .npmrc in the current directory (each overriding the one before), and then the npm_config_*
+# environment variables. ${VAR} references in the files are replaced with environment variables.
+def read_npm_config():
+    config = {}
+
+    def read_npmrc(filename):
+        try:
+            with open(filename, encoding='UTF-8') as file:
+                lines = file.readlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith(';') or '=' not in line:
+                continue
+            (key, value) = (part.strip() for part in line.split('=', 1))
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+                value = value[1:-1]
+            config[key] = re.sub('\\$\\{([^}]+)\\}', lambda match: os.getenv(match.group(1), ''), value)
+
+    environment = {name[len('npm_config_'):].replace('_', '-'): value for (name, value) in os.environ.items() if name.lower().startswith('npm_config_')}
+    environment = {name.lower(): value for (name, value) in environment.items()}
+    node = shutil.which('node')
+    prefix = environment.get('prefix') or (os.path.dirname(os.path.dirname(os.path.realpath(node))) if node else None)
+    if environment.get('globalconfig') or prefix:
+        read_npmrc(environment.get('globalconfig') or os.path.join(prefix, 'etc', 'npmrc'))
+    read_npmrc(environment.get('userconfig') or os.path.join(os.path.expanduser('~'), '.npmrc'))
+    read_npmrc(os.path.join(os.getcwd(), '.npmrc'))
+    config.update(environment)
+    return config
+
+# Replaced in __main__ with the result of read_npm_config.
+npm_config = {}
+
+# Returns the value for the Authorization header that npm would send to registry_url, from the
+# _authToken (or _auth) setting for the longest matching //host/path/ prefix of the URL, if any.
+def get_npm_authorization(registry_url):
+    url = urllib.parse.urlsplit(registry_url)
+    path = url.path.rstrip('/') + '/'
+    while True:
+        prefix = f'//{url.netloc}{path}'
+        if npm_config.get(prefix + ':_authToken'):
+            return 'Bearer ' + npm_config[prefix + ':_authToken']
+        if npm_config.get(prefix + ':_auth'):
+            return 'Basic ' + npm_config[prefix + ':_auth']
+        if path == '/':
+            return None
+        path = path.rstrip('/').rsplit('/', 1)[0] + '/'
+
+# Returns the URL of the proxy that npm would use for registry_url, or None. Like npm, this uses
+# the https-proxy (for https registries) or proxy setting, which default to the HTTPS_PROXY and
+# HTTP_PROXY environment variables, except for the hosts listed in noproxy (or NO_PROXY).
+def get_npm_proxy(registry_url):
+    url = urllib.parse.urlsplit(registry_url)
+    no_proxy = npm_config.get('noproxy') or os.getenv('NO_PROXY') or os.getenv('no_proxy') or ''
+    for host in no_proxy.split(','):
+        host = host.strip().lstrip('.')
+        if host == '*' or (host and (url.hostname == host or url.hostname.endswith('.' + host))):
+            return None
+    http_proxy = npm_config.get('proxy') or os.getenv('HTTP_PROXY') or os.getenv('http_proxy')
+    if url.scheme == 'https':
+        return npm_config.get('https-proxy') or os.getenv('HTTPS_PROXY') or os.getenv('https_proxy') or http_proxy
+    return http_proxy
+
+# Minimal client for the npm registry packument API. Connections are kept alive and reused, so a
+# run of sequential lookups all go through a single connection. Packuments are fetched at most
+# once per package per process. Requests go through the proxy (if any) and send the credentials
+# (if any) that npm is configured to use for registry_url.
+class RegistryClient:
+    def __init__(self, registry_url):
+        url = urllib.parse.urlsplit(registry_url)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise Exception("Error: Invalid npm registry URL: " + registry_url)
+        self.registry_url = registry_url
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/') + '/'
+        self.authorization = get_npm_authorization(registry_url)
+        self.proxy = urllib.parse.urlsplit(get_npm_proxy(registry_url) or '')
+        self.idle_connections = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.packument_locks = {}
+        self.packuments = {}
+
+    def connect(self):
+        # Imported here rather than at the top because it is slow to import, and most commands never
+        # talk to the registry.
+        import http.client
+        import ssl
+        # Like npm, trust the certificates in the cafile setting (for registries behind a corporate CA).
+        context = ssl.create_default_context(cafile=npm_config.get('cafile') or None)
+        if not self.proxy.hostname:
+            if self.scheme == 'https':
+                return http.client.HTTPSConnection(self.host, self.port, timeout=60, context=context)
+            return http.client.HTTPConnection(self.host, self.port, timeout=60)
+        proxy_headers = {}
+        if self.proxy.username:
+            credentials = urllib.parse.unquote(self.proxy.username) + ':' + urllib.parse.unquote(self.proxy.password or '')
+            proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('UTF-8')).decode('ASCII')
+        if self.scheme == 'https':
+            # The TLS connection to the registry is tunneled through the proxy with CONNECT.
+            connection = http.client.HTTPSConnection(self.proxy.hostname, self.proxy.port or 80, timeout=60, context=context)
+            connection.set_tunnel(self.host, self.port, proxy_headers)
+            return connection
+        connection = http.client.HTTPConnection(self.proxy.hostname, self.proxy.port or 80, timeout=60)
+        connection.proxy_headers = proxy_headers
+        return connection
+
+    def get(self, path, headers):
+        with trace_span(path, 'registry', url=self.registry_url + path.lstrip('/')) as span:
+            (response, body) = self.request(path, headers)
+            span['status'] = response.status
+            return (response, body)
+
+    def request(self, path, headers):
+        import http.client
+        try:
+            connection = self.idle_connections.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self.connect()
+            reused = False
+        headers = dict(headers)
+        if self.authorization:
+            headers['Authorization'] = self.authorization
+        if self.proxy.hostname and self.scheme == 'http':
+            # Plain HTTP requests are sent to the proxy with the full URL.
+            headers.update(connection.proxy_headers)
+            path = f'http://{self.host}{":" + str(self.port) if self.port else ""}{path}'
+        while True:
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError) as error:
+                connection.close()
+                if not reused:
+                    raise Exception(f"Error: Request to {self.registry_url} failed: {error}")
+                # The server closed an idle connection; retry once on a fresh one.
+                connection = self.connect()
+                reused = False
+        if response.will_close:
+            connection.close()
+        else:
+            self.idle_connections.put(connection)
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return (response, body)
+
+    def get_packument(self, package):
+        with self.lock:
+            package_lock = self.packument_locks.setdefault(package, threading.Lock())
+        with package_lock:
+            if package in self.packuments:
+                return self.packuments[package]
+            (packument, _) = self.fetch_packument(package)
+            self.packuments[package] = packument
+            return packument
+
+    # Fetches the packument for package, bypassing the ones kept by get_packument. When validators
+    # (from an earlier call) are given, the request is conditional, and the packument is None if it
+    # has not changed since then. Returns (packument, validators).
+    def fetch_packument(self, package, validators = None):
+        path = self.base_path + urllib.parse.quote(package, safe='@')
+        headers = {
+            # The abbreviated packument has everything needed here and is much smaller.
+            'Accept': 'application/vnd.npm.install-v1+json; q=1.0, application/json; q=0.8',
+            'Accept-Encoding': 'gzip',
+        }
+        if validators and validators['etag']:
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators['last_modified']:
+            headers['If-Modified-Since'] = validators['last_modified']
+        (response, body) = self.get(path, headers)
+        if response.status == 304 and validators:
+            return (None, validators)
+        if response.status == 404:
+            raise Exception(f"Error: Package {package} not found in {self.registry_url}")
+        if response.status != 200:
+            raise Exception(f"Error: Request for {package} from {self.registry_url} failed with HTTP status {response.status}")
+        validators = {'etag': response.getheader('ETag'), 'last_modified': response.getheader('Last-Modified')}
+        return (json.loads(body), validators)
+
+    def get_versions(self, package):
+        return list(self.get_packument(package).get('versions', {}))
+
+    def get_dependencies(self, package, version):
+        versions = self.get_packument(package).get('versions', {})
+        if version not in versions:
+            raise Exception(f"Error: Version {version} of {package} not found in {self.registry_url}")
+        return versions[version].get('dependencies', {})
+
+# Replaced in __main__ with a client for the configured registry.
+registry_client = RegistryClient(npm_registry)
+registry_clients = {}
+registry_clients_lock = threading.Lock()
+
+# Returns the client for the registry that npm uses for package: the one configured for its scope
+# (with @scope:registry), if any, and otherwise registry_client.
+def get_registry_client(package):
+    scope_registry = npm_config.get(package.split('/')[0] + ':registry') if package.startswith('@') else None
+    if not scope_registry:
+        return registry_client
+    with registry_clients_lock:
+        if scope_registry not in registry_clients:
+            registry_clients[scope_registry] = RegistryClient(scope_registry)
+        return registry_clients[scope_registry]
+
+itwin_non_core_regex = None
+
 def is_itwin_non_core_project_line(line, is_itwin):
+    global itwin_non_core_regex
     if not is_itwin: return False
-    for itwin_non_core_package in itwin_non_core_packages:
-        if line.find(f'@itwin/{itwin_non_core_package}') != -1:
-            return True
-    return False
+    if itwin_non_core_regex is None:
+        itwin_non_core_regex = re.compile('|'.join(re.escape(f'@itwin/{package}') for package in itwin_non_core_packages))
+    return itwin_non_core_regex.search(line) is not None
 
 def parse_replacement_tuple(tuple):
     if len(tuple) == 2:
@@ -160,16 +600,305 @@ def parse_replacement_tuple(tuple):
     else:
         return (tuple[0], tuple[1], tuple[2])
 
-def replace_all(filename, replacements):
-    num_found = 0
-    for line in fileinput.input(filename, inplace=1):
-        newline = line
+# Returns the index just past the quantifier (if any) at index i of search_exp, and whether that
+# quantifier allows zero repetitions.
+def skip_quantifier(search_exp, i):
+    if i >= len(search_exp) or search_exp[i] not in '?*+{':
+        return (i, False)
+    optional = search_exp[i] != '+'
+    if search_exp[i] == '{':
+        end = search_exp.find('}', i)
+        if end == -1:
+            return (i, False)
+        optional = search_exp[i + 1:end].split(',')[0].strip() in ('', '0')
+        i = end
+    i += 1
+    if i < len(search_exp) and search_exp[i] in '?+':
+        # Lazy or possessive quantifier suffix.
+        i += 1
+    return (i, optional)
+
+# Returns the runs of literal characters that every match of search_exp must contain, longest
+# first. This is only used to skip lines that can't possibly match, so it errs on the side of
+# returning fewer runs (or none at all).
+def get_required_literals(search_exp):
+    if '|' in search_exp or '(?i' in search_exp:
+        return []
+    runs = []
+    run = ''
+    group_starts = []
+    i = 0
+    while i < len(search_exp):
+        c = search_exp[i]
+        literal = None
+        if c == '\\':
+            next_c = search_exp[i + 1:i + 2]
+            if next_c and not next_c.isalnum():
+                literal = next_c
+            # Otherwise this is a character class escape (\s, \d, etc.) or a backreference.
+            i += 2
+        elif c == '[':
+            i += 1
+            if search_exp.startswith('^', i): i += 1
+            if search_exp.startswith(']', i): i += 1
+            while i < len(search_exp) and search_exp[i] != ']':
+                i += 2 if search_exp[i] == '\\' else 1
+            i += 1
+        elif c == '(':
+            runs.append(run)
+            run = ''
+            if search_exp.startswith('(?', i) and not search_exp.startswith('(?:', i) and not search_exp.startswith('(?P<', i):
+                # Lookaround or other special group: none of its contents are required.
+                depth = 0
+                while i < len(search_exp):
+                    if search_exp[i] == '\\':
+                        i += 2
+                        continue
+                    if search_exp[i] == '(':
+                        depth += 1
+                    elif search_exp[i] == ')':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    i += 1
+                (i, _) = skip_quantifier(search_exp, i + 1)
+            else:
+                group_starts.append(len(runs))
+                i += 1
+            continue
+        elif c == ')':
+            if not group_starts:
+                return []
+            runs.append(run)
+            run = ''
+            group_start = group_starts.pop()
+            (i, optional) = skip_quantifier(search_exp, i + 1)
+            if optional:
+                # Nothing inside an optional group is required.
+                del runs[group_start:]
+            continue
+        elif c in '?*+{':
+            # A quantifier with nothing to apply to; give up.
+            return []
+        elif c not in '.^$':
+            literal = c
+            i += 1
+        else:
+            i += 1
+        quantifier_start = i
+        (i, optional) = skip_quantifier(search_exp, i)
+        if literal is None or optional:
+            runs.append(run)
+            run = ''
+        elif i != quantifier_start:
+            # A repeated character is contiguous with the run before it and the run after it,
+            # but the two runs aren't contiguous with each other.
+            runs.append(run + literal)
+            run = literal
+        else:
+            run += literal
+    if group_starts:
+        return []
+    runs.append(run)
+    return sorted(set(run for run in runs if run), key=len, reverse=True)
+
+# A compiled set of replacement tuples. Lines that don't contain any of the rules' required
+# literals are rejected without running a regex, and lines that do are checked against a single
+# combined regex before the individual rules are applied.
+class ReplacementRules:
+    def __init__(self, replacements):
+        parsed = []
+        literal_counts = {}
         for tuple in replacements:
             (search_exp, replace_exp, is_itwin) = parse_replacement_tuple(tuple)
-            if re.search(search_exp, newline) and not is_itwin_non_core_project_line(newline, is_itwin):
+            literals = get_required_literals(search_exp)
+            for literal in literals:
+                literal_counts[literal] = literal_counts.get(literal, 0) + 1
+            parsed.append((search_exp, replace_exp, is_itwin, literals))
+        self.rules = []
+        self.literals = []
+        self.unfiltered = False
+        for (search_exp, replace_exp, is_itwin, literals) in parsed:
+            rule_literal = None
+            if literals:
+                # The line prefilter uses the literal shared by the most rules (ignoring very short
+                # ones, which match nearly every line), so that it stays short. Each rule is then
+                # checked with its most distinctive literal.
+                prefilter_literals = [literal for literal in literals if len(literal) >= 4] or literals
+                shared_literal = max(prefilter_literals, key=lambda literal: (literal_counts[literal], len(literal)))
+                if shared_literal not in self.literals:
+                    self.literals.append(shared_literal)
+                rule_literal = min(literals, key=lambda literal: (literal_counts[literal], -len(literal)))
+            else:
+                self.unfiltered = True
+            self.rules.append((re.compile(search_exp), replace_exp, is_itwin, rule_literal))
+        # Any line containing a longer prefilter literal also contains the shorter one inside it.
+        self.literals = [
+            literal for literal in self.literals
+            if not any(other != literal and other in literal for other in self.literals)
+        ]
+        if self.rules:
+            self.matcher = re.compile('|'.join(f'(?:{rule[0].pattern})' for rule in self.rules))
+        else:
+            self.matcher = None
+
+    # Returns the modified line and the number of rules that matched it. The rules are applied in
+    # order, each one to the output of the previous one, exactly like the original line-by-line
+    # implementation, so the match counts used by the "Not enough replacements" checks are unchanged.
+    def apply(self, line):
+        if self.matcher is None:
+            return (line, 0)
+        if not self.unfiltered:
+            for literal in self.literals:
+                if literal in line:
+                    break
+            else:
+                return (line, 0)
+        if not self.matcher.search(line):
+            return (line, 0)
+        num_found = 0
+        for (search_regex, replace_exp, is_itwin, literal) in self.rules:
+            if literal is not None and literal not in line:
+                continue
+            (newline, count) = search_regex.subn(replace_exp, line)
+            if count and not is_itwin_non_core_project_line(line, is_itwin):
                 num_found += 1
-                newline = re.sub(search_exp, replace_exp, newline)
-        sys.stdout.write(newline)
+                line = newline
+        return (line, num_found)
+
+compiled_replacements = {}
+
+def compile_replacements(replacements):
+    if isinstance(replacements, ReplacementRules):
+        return replacements
+    key = tuple(parse_replacement_tuple(tuple) for tuple in replacements)
+    if key not in compiled_replacements:
+        compiled_replacements[key] = ReplacementRules(replacements)
+    return compiled_replacements[key]
+
+def write_file_atomically(filename, data):
+    (fd, temp_filename) = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.' + os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        if os.path.exists(filename):
+            shutil.copymode(filename, temp_filename)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+# Collects file rewrites in memory so that a group of them is written all at once, or not at all.
+# Each file is read once, and is only written (atomically, via a rename) if its content actually
+# changed, so unchanged files keep their modification times. Like fileinput, files are read with
+# universal newlines.
+class RewriteTransaction:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.original_data = {}
+        self.original_contents = {}
+        self.contents = {}
+
+    def read(self, filename):
+        filename = os.path.realpath(filename)
+        with self.lock:
+            if filename in self.contents:
+                return self.contents[filename]
+        with open(filename, 'rb') as file:
+            data = file.read()
+        content = data.decode('UTF-8').replace('\r\n', '\n').replace('\r', '\n')
+        with self.lock:
+            if filename not in self.contents:
+                self.original_data[filename] = data
+                self.original_contents[filename] = content
+                self.contents[filename] = content
+            return self.contents[filename]
+
+    def write(self, filename, content):
+        filename = os.path.realpath(filename)
+        with self.lock:
+            if filename not in self.contents:
+                raise Exception("Error: File written without being read first: " + filename)
+            self.contents[filename] = content
+
+    def changed_files(self):
+        with self.lock:
+            return [filename for filename in self.contents if self.contents[filename] != self.original_contents[filename]]
+
+    # Writes all the changed files. If writing any of them fails, the ones that were already
+    # written are restored to their original content.
+    def commit(self):
+        written = []
+        try:
+            for filename in self.changed_files():
+                write_file_atomically(filename, self.contents[filename].encode('UTF-8'))
+                written.append(filename)
+        except BaseException:
+            for filename in written:
+                write_file_atomically(filename, self.original_data[filename])
+            raise
+        return written
+
+active_transaction = None
+
+# The real paths of the files written by rewrite transactions and npm installs, so that commit_dir
+# only has to check and commit those files instead of scanning each whole worktree. The journal of a
+# stage records them, so that a resumed stage still knows what it changed before.
+touched_paths = set()
+touched_paths_lock = threading.Lock()
+
+def record_touched_paths(filenames):
+    with touched_paths_lock:
+        touched_paths.update(os.path.realpath(filename) for filename in filenames)
+
+# Returns the recorded touched paths inside dir, relative to it.
+def get_touched_paths(dir):
+    dir = os.path.realpath(dir)
+    with touched_paths_lock:
+        return sorted(os.path.relpath(path, dir) for path in touched_paths if path.startswith(dir + os.sep))
+
+# All file rewrites made inside this context are written when it exits normally, and discarded if
+# it exits with an exception. Nested uses join the outermost transaction. With dry_run, nothing is
+# ever written, and the caller can inspect the yielded transaction instead.
+@contextlib.contextmanager
+def rewrite_transaction(dry_run = False):
+    global active_transaction
+    if active_transaction is not None:
+        yield active_transaction
+        return
+    transaction = RewriteTransaction()
+    active_transaction = transaction
+    try:
+        yield transaction
+    except BaseException:
+        changed_files = transaction.changed_files()
+        if changed_files and not dry_run:
+            print(f"Discarding changes to {len(changed_files)} file(s); no files were modified.")
+        raise
+    finally:
+        active_transaction = None
+    if not dry_run:
+        record_touched_paths(transaction.commit())
+
+# Splits content into lines, keeping the line endings. Unlike str.splitlines, only '\n' ends a line.
+def split_lines(content):
+    lines = [line + '\n' for line in content.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def replace_all(filename, replacements):
+    rules = compile_replacements(replacements)
+    num_found = 0
+    newlines = []
+    with rewrite_transaction() as transaction:
+        for line in split_lines(transaction.read(filename)):
+            (newline, found) = rules.apply(line)
+            num_found += found
+            newlines.append(newline)
+        transaction.write(filename, ''.join(newlines))
     return num_found
 
 def itwin_base_version_search_tuples(first_format_string, second_value, is_itwin = False):
@@ -186,49 +915,171 @@ def mobile_base_version_search_tuples(first_format_string, second_value):
 
 def get_packages_tuples(packages, prefix, group_name):
     version = get_latest_version(f'@itwin/{packages[0]}', prefix)
-    print(f'{group_name} version: {version}')
+    log(f'{group_name} version: {version}')
     result = []
     for package in packages:
         result.append((f'("@itwin/{package}"): "[0-9][.0-9a-z-]+', '\\1: "' + version))
     return result
 
+# The groups of iTwin non-core packages that share a version, along with the version prefix to
+# search for and the name to show for each group.
+def get_itwin_non_core_groups():
+    return [
+        (appui_packages, '4', 'appui'),
+        (appui_layout_packages, '4', 'appui_layout'),
+        (imodels_access_packages, '4', 'imodels_access'),
+        (itwins_client_packages, '1', 'itwins_client'),
+        (imodels_client_packages, '4', 'imodels_client'),
+        (presentation_packages, '4', 'presentation'),
+    ]
+
+def get_itwin_non_core_version_keys():
+    return [(f'@itwin/{packages[0]}', prefix) for (packages, prefix, _) in get_itwin_non_core_groups()]
+
 def get_itwin_non_core_tuples():
+    prefetch_latest_versions(get_itwin_non_core_version_keys())
     result = []
-    result.extend(get_packages_tuples(appui_packages, '4', 'appui'))
-    result.extend(get_packages_tuples(appui_layout_packages, '4', 'appui_layout'))
-    result.extend(get_packages_tuples(imodels_access_packages, '4', 'imodels_access'))
-    result.extend(get_packages_tuples(itwins_client_packages, '1', 'itwins_client'))
-    result.extend(get_packages_tuples(imodels_client_packages, '4', 'imodels_client'))
-    result.extend(get_packages_tuples(presentation_packages, '4', 'presentation'))
+    for (packages, prefix, group_name) in get_itwin_non_core_groups():
+        result.extend(get_packages_tuples(packages, prefix, group_name))
     return result
 
+def get_package_json_tuples(args):
+    tuples = get_itwin_non_core_tuples()
+    # IMPORTANT: The @itwin/mobile-sdk-core and @itwin/mobile-ui-react replacements must
+    # come last.
+    tuples.extend(
+        [
+            ('("version": )"[.0-9a-z-]+', '\\1"' + args.new_mobile),
+        ] + itwin_base_version_search_tuples(
+            '("' + itwin_scope + '/[0-9a-z-]+"): "{0}[.0-9a-z-]+',
+            '\\1: "' + args.new_itwin,
+            True
+        ) + [
+            ('("@itwin/mobile-sdk-core"): "[0-9][.0-9a-z-]+', '\\1: "' + args.current_mobile),
+            ('("@itwin/mobile-ui-react"): "[0-9][.0-9a-z-]+', '\\1: "' + args.current_mobile),
+        ]
+    )
+    return tuples
+
+# Returns the table of package name to new version used by modify_package_json. @itwin packages
+# that aren't in the table or in itwin_non_core_packages are iTwin core packages.
+def get_package_json_versions(args):
+    prefetch_latest_versions(get_itwin_non_core_version_keys())
+    versions = {}
+    for (packages, prefix, group_name) in get_itwin_non_core_groups():
+        version = get_latest_version(f'@itwin/{packages[0]}', prefix)
+        log(f'{group_name} version: {version}')
+        for package in packages:
+            versions[f'@itwin/{package}'] = version
+    versions['@itwin/mobile-sdk-core'] = args.current_mobile
+    versions['@itwin/mobile-ui-react'] = args.current_mobile
+    return versions
+
+json_whitespace_regex = re.compile('[ \t\n\r]*')
+json_decoder = json.JSONDecoder()
+
+def skip_json_whitespace(content, index):
+    return json_whitespace_regex.match(content, index).end()
+
+# Returns (key, value_start, value_end) for each member of the JSON object that starts at index,
+# so that values can be replaced without disturbing the rest of the file's formatting.
+def get_json_object_members(content, index):
+    members = []
+    index = skip_json_whitespace(content, index)
+    if content[index:index + 1] != '{':
+        raise ValueError(f'Expecting object at {index}')
+    index = skip_json_whitespace(content, index + 1)
+    if content[index:index + 1] == '}':
+        return members
+    while True:
+        if content[index:index + 1] != '"':
+            raise ValueError(f'Expecting property name at {index}')
+        (key, index) = json.decoder.scanstring(content, index + 1)
+        index = skip_json_whitespace(content, index)
+        if content[index:index + 1] != ':':
+            raise ValueError(f"Expecting ':' at {index}")
+        start = skip_json_whitespace(content, index + 1)
+        (_, end) = json_decoder.raw_decode(content, start)
+        members.append((key, start, end))
+        index = skip_json_whitespace(content, end)
+        if content[index:index + 1] == '}':
+            return members
+        if content[index:index + 1] != ',':
+            raise ValueError(f"Expecting ',' at {index}")
+        index = skip_json_whitespace(content, index + 1)
+
+# Applies a list of (start, end, replacement) edits to content. The edits must not overlap.
+def apply_text_edits(content, edits):
+    result = []
+    position = 0
+    for (start, end, replacement) in sorted(edits):
+        result.append(content[position:start])
+        result.append(replacement)
+        position = end
+    result.append(content[position:])
+    return ''.join(result)
+
+# If the JSON string between start and end begins with a match for version_regex, adds an edit
+# that replaces the matched part with new_version. Returns True if an edit was added.
+def add_json_version_edit(edits, content, start, end, version_regex, new_version):
+    if content[start] != '"':
+        return False
+    match = version_regex.match(content, start + 1, end - 1)
+    if not match:
+        return False
+    edits.append((match.start(), match.end(), new_version))
+    return True
+
+version_value_regex = re.compile('[.0-9a-z-]+')
+package_version_regex = re.compile('[0-9][.0-9a-z-]+')
+itwin_base_version_regex = None
+
+def get_itwin_base_version_regex():
+    global itwin_base_version_regex
+    if itwin_base_version_regex is None:
+        itwin_base_version_regex = re.compile('(?:' + '|'.join(itwin_base_version_search_list) + ')[.0-9a-z-]+')
+    return itwin_base_version_regex
+
+def is_itwin_core_package(package):
+    scope_prefix = itwin_scope + '/'
+    return package.startswith(scope_prefix) and package[len(scope_prefix):] not in itwin_non_core_packages
+
+# Updates the top-level version and the package_json_dependency_maps entries of the package.json
+# content. Returns the new content and the number of values that were updated.
+def update_package_json_content(content, new_mobile, new_itwin, versions):
+    edits = []
+    for (key, start, end) in get_json_object_members(content, 0):
+        if key == 'version':
+            add_json_version_edit(edits, content, start, end, version_value_regex, new_mobile)
+        elif key in package_json_dependency_maps and content[start] == '{':
+            for (package, value_start, value_end) in get_json_object_members(content, start):
+                if package in versions:
+                    add_json_version_edit(edits, content, value_start, value_end, package_version_regex, versions[package])
+                elif is_itwin_core_package(package):
+                    add_json_version_edit(edits, content, value_start, value_end, get_itwin_base_version_regex(), new_itwin)
+    return (apply_text_edits(content, edits), len(edits))
+
+@traced_rewrite
 def modify_package_json(args, dir):
     filename = os.path.join(dir, 'package.json')
     if os.path.exists(filename):
-        print("Processing: " + filename)
-        tuples = get_itwin_non_core_tuples()
-        # IMPORTANT: The @itwin/mobile-sdk-core and @itwin/mobile-ui-react replacements must
-        # come last.
-        tuples.extend(
-            [
-                ('("version": )"[.0-9a-z-]+', '\\1"' + args.new_mobile),
-            ] + itwin_base_version_search_tuples(
-                '("' + itwin_scope + '/[0-9a-z-]+"): "{0}[.0-9a-z-]+',
-                '\\1: "' + args.new_itwin,
-                True
-            ) + [
-                ('("@itwin/mobile-sdk-core"): "[0-9][.0-9a-z-]+', '\\1: "' + args.current_mobile),
-                ('("@itwin/mobile-ui-react"): "[0-9][.0-9a-z-]+', '\\1: "' + args.current_mobile),
-            ]
-        )
-        if replace_all(filename, tuples) < 2:
+        log("Processing: " + filename)
+        versions = get_package_json_versions(args)
+        with rewrite_transaction() as transaction:
+            try:
+                (content, num_found) = update_package_json_content(transaction.read(filename), args.new_mobile, args.new_itwin, versions)
+            except ValueError as error:
+                raise Exception(f"Error: Cannot parse {filename}: {error}")
+            transaction.write(filename, content)
+        if num_found < 2:
             raise Exception("Not enough replacements")
 
+@traced_rewrite
 def modify_readme_md(args, dir):
     filename = os.path.join(dir, 'README.md')
     if not os.path.exists(filename):
         raise Exception("Error: Cannot find " + filename)
-    print("Processing: " + filename)
+    log("Processing: " + filename)
     if replace_all(
         filename,
         itwin_base_version_search_tuples(
@@ -260,61 +1111,156 @@ def modify_readme_md(args, dir):
     ) < 5:
         raise Exception("Not enough replacements")
 
+@traced_rewrite
 def modify_package_swift(args, filename):
-    print("Processing: " + os.path.realpath(filename))
+    log("Processing: " + os.path.realpath(filename))
     if replace_all(filename, [('(mobile-native-ios", .exact\\()"[.0-9a-z-]+', '\\1"' + args.new_add_on)]) != 1:
         raise Exception("Not enough replacements")
 
+@traced_rewrite
 def modify_podspec(args, filename):
-    print("Processing: " + os.path.realpath(filename))
+    log("Processing: " + os.path.realpath(filename))
     replacements = [('(spec\\.version\\s+=\\s+")[.0-9a-z-]+"', '\\g<1>' + args.new_mobile + '"')]
     replacements.append(('(spec\\.dependency\\s+"itwin-mobile-native",\\s+")[.0-9a-z-]+"', '\\g<1>' + args.new_add_on + '"'))
     if replace_all(filename, replacements) != 2:
         raise Exception("Not enough replacements")
 
+pbxproj_section_regex = re.compile('/\\* Begin XCRemoteSwiftPackageReference section \\*/(.*?)/\\* End XCRemoteSwiftPackageReference section \\*/', re.S)
+pbxproj_reference_regex = re.compile('repositoryURL = (?:"([^"]*)"|([^;\\s]*));\\s*requirement = \\{([^}]*)\\};')
+pbxproj_version_regex = re.compile('(?<![A-Za-z])version\\s*=\\s*("[^"]*"|[^;\\s]+);')
+
+# Returns a map from repository URL to the (start, end) offsets of the requirement version values
+# of the XCRemoteSwiftPackageReference entries for that repository in the pbxproj content.
+def get_pbxproj_package_index(content):
+    index = {}
+    section = pbxproj_section_regex.search(content)
+    if not section:
+        return index
+    for reference in pbxproj_reference_regex.finditer(content, section.start(1), section.end(1)):
+        url = reference.group(1) if reference.group(1) is not None else reference.group(2)
+        version = pbxproj_version_regex.search(content, reference.start(3), reference.end(3))
+        if version:
+            index.setdefault(url, []).append(version.span(1))
+    return index
+
+def get_pbxproj_package_versions(args):
+    return {
+        'https://github.com/iTwin/mobile-sdk-ios.git': args.new_mobile,
+    }
+
+# Updates the requirement versions of the Swift packages in versions (a map from repository URL to
+# version). Returns the new content and the number of versions that were updated.
+def update_pbxproj_content(content, versions):
+    if not any(url in content for url in versions):
+        return (content, 0)
+    edits = []
+    for (url, spans) in get_pbxproj_package_index(content).items():
+        if url in versions:
+            version = versions[url]
+            if re.search('[a-z-]', version):
+                version = '"' + version + '"'
+            edits.extend((start, end, version) for (start, end) in spans)
+    return (apply_text_edits(content, edits), len(edits))
+
+@traced_rewrite
 def modify_project_pbxproj(args, filename):
-    print("Processing: " + os.path.realpath(filename))
-    repository = None
-    new_mobile = args.new_mobile
-    if re.search('[a-z-]', new_mobile):
-        new_mobile = '"' + new_mobile + '"'
-    for line in fileinput.input(filename, inplace=1):
-        if re.search('repositoryURL = "https://github.com/iTwin/mobile-sdk-ios.git";', line):
-            repository = 'mobile-sdk-ios'
-        if repository == 'mobile-sdk-ios':
-            if re.search('version\\s+=\\s+[.0-9a-z"-]+;', line):
-                line = re.sub('(version\\s+=\\s+)[.0-9a-z"-]+;', '\\g<1>' + new_mobile + ';', line)
-                repository = None
-        sys.stdout.write(line)
+    log("Processing: " + os.path.realpath(filename))
+    versions = get_pbxproj_package_versions(args)
+    with rewrite_transaction() as transaction:
+        (content, _) = update_pbxproj_content(transaction.read(filename), versions)
+        transaction.write(filename, content)
+
+# Returns (start, end) for each element of the JSON array that starts at index.
+def get_json_array_elements(content, index):
+    elements = []
+    index = skip_json_whitespace(content, index)
+    if content[index:index + 1] != '[':
+        raise ValueError(f'Expecting array at {index}')
+    index = skip_json_whitespace(content, index + 1)
+    if content[index:index + 1] == ']':
+        return elements
+    while True:
+        (_, end) = json_decoder.raw_decode(content, index)
+        elements.append((index, end))
+        index = skip_json_whitespace(content, end)
+        if content[index:index + 1] == ']':
+            return elements
+        if content[index:index + 1] != ',':
+            raise ValueError(f"Expecting ',' at {index}")
+        index = skip_json_whitespace(content, index + 1)
+
+# If the whole JSON string between start and end matches value_regex and differs from new_value,
+# adds an edit that replaces it with new_value.
+def add_json_string_edit(edits, content, start, end, value_regex, new_value):
+    if content[start] == '"' and value_regex.fullmatch(content, start + 1, end - 1):
+        replacement = json.dumps(new_value)
+        if content[start:end] != replacement:
+            edits.append((start, end, replacement))
 
 # Note: the "itwin-mobile-sdk" Swift Package is now showing up as "mobile-sdk-ios" inside the
 # Package.resolved files. I don't know if this is due to an Xcode update or some other change
 # that I'm unaware of. Because of that uncertainty, this code recognizes both package names as
 # being valid. The same thing is done for the 'itwin-mobile-native" package. In that case,
 # both names are definitely used (one here in mobile-sdk-ios, and another in mobile-samples).
+def get_package_resolved_pins(args):
+    pins = {}
+    native_pin = (args.new_add_on, getattr(args, 'new_add_on_commit_id', None))
+    pins['itwin-mobile-native'] = native_pin
+    pins['mobile-native-ios'] = native_pin
+    if not skip_commit_id(args):
+        sdk_pin = (args.new_mobile, getattr(args, 'new_commit_id', None))
+        pins['itwin-mobile-sdk'] = sdk_pin
+        pins['mobile-sdk-ios'] = sdk_pin
+    return pins
+
+resolved_version_regex = re.compile('[0-9].*')
+resolved_revision_regex = re.compile('[0-9A-Fa-f]*')
+
+# Updates the version and revision of the pins in the Package.resolved content that are in pins (a
+# map from package name to (version, revision)). Handles both the v1 format (object.pins, with
+# package names) and the v2+ format (pins, with identities). Returns the new content and the number
+# of values that were changed.
+def update_package_resolved_content(content, pins):
+    members = {key: start for (key, start, _) in get_json_object_members(content, 0)}
+    if 'pins' in members:
+        pins_start = members['pins']
+    elif 'object' in members:
+        pins_start = {key: start for (key, start, _) in get_json_object_members(content, members['object'])}.get('pins')
+    else:
+        pins_start = None
+    if pins_start is None:
+        raise ValueError('No pins found')
+    edits = []
+    for (pin_start, _) in get_json_array_elements(content, pins_start):
+        pin = {key: (start, end) for (key, start, end) in get_json_object_members(content, pin_start)}
+        name = None
+        for key in ['identity', 'package']:
+            if key in pin:
+                name = json.loads(content[pin[key][0]:pin[key][1]])
+                break
+        if name not in pins or 'state' not in pin:
+            continue
+        (version, revision) = pins[name]
+        for (key, start, end) in get_json_object_members(content, pin['state'][0]):
+            if key == 'version':
+                add_json_string_edit(edits, content, start, end, resolved_version_regex, version)
+            elif key == 'revision' and revision:
+                add_json_string_edit(edits, content, start, end, resolved_revision_regex, revision)
+    return (apply_text_edits(content, edits), len(edits))
+
+@traced_rewrite
 def modify_package_resolved(args, filename):
-    print("Processing: " + os.path.realpath(filename))
-    package = None
-    for line in fileinput.input(filename, inplace=1):
-        match = re.search('"package"\\s*: "(.*)"', line)
-        if match and len(match.groups()) == 1:
-            package = match.group(1)
-        else:
-            match = re.search('"identity"\\s*:\\s*"(.*)"', line)
-            if match and len(match.groups()) == 1:
-                package = match.group(1)
-        if package == 'itwin-mobile-native' or package == 'mobile-native-ios':
-            line = re.sub('("version"\\s*:\\s*)"[0-9].*"', '\\1"' + args.new_add_on + '"', line)
-            if hasattr(args, 'new_add_on_commit_id') and args.new_add_on_commit_id:
-                line = re.sub('("revision"\\s*:\\s*)"[0-9A-Fa-f]*"', '\\1"' + args.new_add_on_commit_id + '"', line)
-        elif (package == 'itwin-mobile-sdk' or package == 'mobile-sdk-ios') and not skip_commit_id(args):
-            line = re.sub('("version"\\s*:\\s*)"[0-9].*"', '\\1"' + args.new_mobile + '"', line)
-            if hasattr(args, 'new_commit_id') and args.new_commit_id:
-                line = re.sub('("revision"\\s*:\\s*)"[0-9A-Fa-f]*"', '\\1"' + args.new_commit_id + '"', line)
-        sys.stdout.write(line)
+    log("Processing: " + os.path.realpath(filename))
+    with rewrite_transaction() as transaction:
+        try:
+            (content, _) = update_package_resolved_content(transaction.read(filename), get_package_resolved_pins(args))
+        except ValueError as error:
+            raise Exception(f"Error: Cannot parse {os.path.realpath(filename)}: {error}")
+        transaction.write(filename, content)
 
+@traced_rewrite
 def modify_build_gradle(args, filename):
-    print("Processing: " + os.path.realpath(filename))
+    log("Processing: " + os.path.realpath(filename))
     if replace_all(
         filename,
         [
@@ -325,8 +1271,9 @@ def modify_build_gradle(args, filename):
     ) != 4:
         raise Exception("Wrong number of replacements")
 
+@traced_rewrite
 def modify_sample_build_gradle(args, filename):
-    print("Processing: " + os.path.realpath(filename))
+    log("Processing: " + os.path.realpath(filename))
     if replace_all(
         filename,
         [
@@ -341,14 +1288,15 @@ def change_command(args):
         ensure_no_dirs_have_diffs()
     if not hasattr(args, 'current_mobile') or not args.current_mobile:
         args.current_mobile = get_last_release()
-    modify_package_swift(args, os.path.join(sdk_dirs.sdk_ios, 'Package.swift'))
-    modify_package_resolved(args, os.path.join(sdk_dirs.sdk_ios, 'Package.resolved'))
-    modify_podspec(args, os.path.join(sdk_dirs.sdk_ios, 'itwin-mobile-sdk.podspec'))
-    modify_readme_md(args, sdk_dirs.sdk_ios)
-    modify_readme_md(args, sdk_dirs.sdk_android)
-    modify_build_gradle(args, os.path.join(sdk_dirs.sdk_android, 'mobile-sdk', 'build.gradle'))
-    # modify_android_yml(args, os.path.join(sdk_dirs.sdk_android, '.github', 'workflows', 'android.yml'))
-    modify_package_json(args, sdk_dirs.sdk_core)
+    with rewrite_transaction():
+        modify_package_swift(args, os.path.join(sdk_dirs.sdk_ios, 'Package.swift'))
+        modify_package_resolved(args, os.path.join(sdk_dirs.sdk_ios, 'Package.resolved'))
+        modify_podspec(args, os.path.join(sdk_dirs.sdk_ios, 'itwin-mobile-sdk.podspec'))
+        modify_readme_md(args, sdk_dirs.sdk_ios)
+        modify_readme_md(args, sdk_dirs.sdk_android)
+        modify_build_gradle(args, os.path.join(sdk_dirs.sdk_android, 'mobile-sdk', 'build.gradle'))
+        # modify_android_yml(args, os.path.join(sdk_dirs.sdk_android, '.github', 'workflows', 'android.yml'))
+        modify_package_json(args, sdk_dirs.sdk_core)
 
 def bump_command(args):
     if not args.force:
@@ -357,15 +1305,21 @@ def bump_command(args):
     change_command(args)
     npm_install_dir(sdk_dirs.sdk_core)
 
+def get_js_dirs():
+    return [
+        sdk_dirs.sdk_core,
+        sdk_dirs.ui_react,
+        os.path.join(sdk_dirs.samples, react_app_subdir),
+        os.path.join(sdk_dirs.samples, token_server_subdir),
+    ]
+
 def changeitwin_command(args):
     args.skip_commit_id = True
-    change_command(args)
-    npm_install_dir(sdk_dirs.sdk_core)
-    changeui_command(args)
-    npm_install_dir(sdk_dirs.ui_react)
-    changesamples_command(args)
-    npm_install_dir(os.path.join(sdk_dirs.samples, react_app_subdir))
-    npm_install_dir(os.path.join(sdk_dirs.samples, token_server_subdir))
+    with rewrite_transaction():
+        change_command(args)
+        changeui_command(args)
+        changesamples_command(args)
+    npm_install_dirs(get_js_dirs())
 
 def bumpitwin_command(args):
     if not args.force:
@@ -377,19 +1331,532 @@ def changeui_command(args):
     args.current_mobile = args.new_mobile
     modify_package_json(args, sdk_dirs.ui_react)
 
+output_lock = threading.Lock()
+# Holds the name of the TaskGraph task (if any) running on the current thread.
+task_context = threading.local()
+
+# Prints message, prefixed with the name of the current task when running in a TaskGraph.
+def log(message):
+    prefix = getattr(task_context, 'prefix', None)
+    with output_lock:
+        for line in message.splitlines():
+            sys.stdout.write(f'[{prefix}] {line}\n' if prefix else f'{line}\n')
+        sys.stdout.flush()
+
+# Like subprocess.check_call, except that when running in a TaskGraph task, the output of the
+# command is prefixed with the name of the task so that the output of tasks running at the same
+# time can be told apart.
+def run_checked(args, cwd = None):
+    prefix = getattr(task_context, 'prefix', None)
+    with trace_subprocess(args, cwd):
+        if prefix is None:
+            subprocess.check_call(args, cwd=cwd)
+            return
+        with subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace') as process:
+            for line in process.stdout:
+                with output_lock:
+                    sys.stdout.write(f'[{prefix}] {line}')
+                    sys.stdout.flush()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+# A set of named tasks with dependencies between them. Tasks can only depend on tasks that were
+# added before them, so the graph can't have cycles. run() executes the tasks on a bounded pool of
+# workers, starting each one as soon as all of its dependencies have finished. After the first
+# failure no new tasks are started, and the error is re-raised once the running tasks finish.
+# When a journal is given, tasks that it records as completed are skipped (as long as their verify
+# function, if any, confirms that their effects are still there), and each task that finishes is
+# recorded in it.
+class TaskGraph:
+    def __init__(self, journal = None):
+        self.tasks = {}
+        self.journal = journal
+
+    def add(self, name, func, dependencies = [], verify = None):
+        if name in self.tasks:
+            raise Exception("Error: Duplicate task: " + name)
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise Exception(f"Error: Task {name} depends on unknown task {dependency}")
+        self.tasks[name] = (func, list(dependencies), verify)
+        return name
+
+    def run_task(self, name, prefixed):
+        task_context.prefix = name if prefixed else None
+        try:
+            with trace_span(name, 'task'):
+                (func, _, verify) = self.tasks[name]
+                if self.journal is not None and self.journal.is_completed(name):
+                    if verify is None or verify():
+                        log("Already completed: " + name)
+                        return
+                    log("Completed in the journal, but its effects are missing; running again: " + name)
+                func()
+                if self.journal is not None:
+                    self.journal.mark_completed(name)
+        finally:
+            task_context.prefix = None
+
+    def run(self, max_workers):
+        # Output is only prefixed when tasks can actually run at the same time.
+        prefixed = max_workers > 1
+        pending = list(self.tasks)
+        running = {}
+        finished = set()
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                if error is None:
+                    for name in [name for name in pending if all(dependency in finished for dependency in self.tasks[name][1])]:
+                        pending.remove(name)
+                        running[executor.submit(self.run_task, name, prefixed)] = name
+                if not running:
+                    break
+                (done, _) = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        finished.add(name)
+                    except Exception as task_error:
+                        if error is None:
+                            log(f"Task failed: {name}")
+                            error = task_error
+        if error is not None:
+            raise error
+
+# Records the inputs (versions and release text) and completed tasks of a stage command, so that
+# rerunning the stage after a failure resumes where it left off instead of starting over.
+class StepJournal:
+    def __init__(self, filename, stage, restart = False):
+        self.filename = filename
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.inputs = {}
+        self.completed = []
+        if not restart and os.path.exists(filename):
+            with open(filename, encoding='UTF-8') as file:
+                data = json.load(file)
+            if data.get('stage') == stage:
+                self.inputs = data.get('inputs', {})
+                self.completed = data.get('completed', [])
+                record_touched_paths(data.get('touched', []))
+
+    def save(self):
+        with touched_paths_lock:
+            touched = sorted(touched_paths)
+        data = {'stage': self.stage, 'inputs': self.inputs, 'completed': self.completed, 'touched': touched}
+        write_file_atomically(self.filename, (json.dumps(data, indent=2) + '\n').encode('UTF-8'))
+
+    def record_inputs(self, args):
+        with self.lock:
+            self.inputs = {name: getattr(args, name) for name in journal_input_names if getattr(args, name, None)}
+            self.save()
+
+    # Restores the recorded inputs into args, failing if args explicitly specifies something else.
+    def restore_inputs(self, args):
+        for (name, value) in self.inputs.items():
+            current = getattr(args, name, None)
+            if current and current != value:
+                raise Exception(f"Error: {name} is {current}, but the {self.stage} journal in {self.filename} was started with {value}. Use --restart to start over.")
+            setattr(args, name, value)
+
+    def is_completed(self, name):
+        with self.lock:
+            return name in self.completed
+
+    def mark_completed(self, name):
+        with self.lock:
+            self.completed.append(name)
+            self.save()
+
+    def finish(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+def get_journal_filename(stage):
+    return os.path.join(sdk_dirs.parent_dir, f'.newVersion-{stage}-journal.json')
+
+# Runs a stage as a journaled TaskGraph. resolve is only called (to fill in the versions in args)
+# when the stage is starting fresh; when resuming, the versions recorded in the journal are used.
+# build_graph adds the stage's tasks to the graph. get_stale_reason is called with the recorded
+# inputs when resuming, and returns why they can't belong to the release in progress (for example,
+# when the failed run was finished by hand and the journal left behind), or None.
+def run_stage(args, stage, resolve, build_graph, get_stale_reason):
+    journal = StepJournal(get_journal_filename(stage), stage, args.restart)
+    if journal.inputs:
+        reason = get_stale_reason(journal.inputs)
+        if reason:
+            raise Exception(f"Error: The {stage} journal in {journal.filename} is out of date: {reason}. Delete it, or use --restart to start over.")
+        print(f"Resuming {stage} ({len(journal.completed)} completed steps) from journal: {journal.filename}")
+        journal.restore_inputs(args)
+    else:
+        resolve()
+        journal.record_inputs(args)
+    graph = TaskGraph(journal)
+    build_graph(graph)
+    try:
+        graph.run(max_stage_jobs)
+    except BaseException:
+        print(f"Completed steps were recorded in {journal.filename}. Run {stage} again to resume, or with --restart to start over.")
+        raise
+    journal.finish()
+
 def npm_build_dir(dir, relativeDeps = False):
-    print('Performing npm run build in dir: ' + dir)
-    if relativeDeps:
+    log('Performing npm run build in dir: ' + dir)
+    if relativeDeps and local_link_mode == 'relative-deps':
         rm_args = ['rm', '-rf', 'node_modules/@itwin/mobile-sdk-core', 'node_modules/@itwin/mobile-ui-react']
-        subprocess.check_call(rm_args, cwd=dir)
+        run_checked(rm_args, cwd=dir)
         npx_args = ['npx', 'relative-deps']
-        subprocess.check_call(npx_args, cwd=dir)
+        run_checked(npx_args, cwd=dir)
+    elif relativeDeps:
+        link_relative_dependencies(dir)
     build_args = ['npm', 'run', 'build']
-    subprocess.check_call(build_args, cwd=dir)
-
+    run_checked(build_args, cwd=dir)
+
+# Set in __main__ from --forceInstall.
+force_npm_install = False
+# The file in node_modules that holds the install hash (see get_npm_install_hash) of the last
+# successful npm install.
+npm_install_hash_filename = '.newVersion-install-hash'
+
+# Returns the output of tool --version. This is cached (on disk, unless --noCache is specified)
+# keyed on the resolved path and modification time of the tool, so it is only run again after the
+# tool is upgraded or a different one is put first in the PATH (by nvm, for example). Starting node
+# or npm takes long enough to be noticeable on every run.
+def get_tool_version(tool):
+    path = shutil.which(tool)
+    if path is None:
+        raise Exception(f"Error: {tool} not found in PATH.")
+    path = os.path.realpath(path)
+
+    def lookup():
+        with trace_subprocess([tool, '--version']):
+            return subprocess.check_output([tool, '--version'], stderr=subprocess.STDOUT, encoding='UTF-8').strip()
+
+    return cached_lookup('tool_version', f'{path}@{os.stat(path).st_mtime_ns}', lookup)
+
+# Returns the node and npm versions.
+def get_toolchain_versions():
+    return tuple(run_concurrently(lambda: get_tool_version('node'), lambda: get_tool_version('npm')))
+
+# Hashes of file contents, keyed on path and signature, so that a file that is in several packages'
+# install hashes (like mobile-sdk-core's) is only read once per run.
+file_digests = {}
+file_digests_lock = threading.Lock()
+
+def get_file_digest(path):
+    key = (path, *get_file_signature(path))
+    with file_digests_lock:
+        if key in file_digests:
+            return file_digests[key]
+    with open(path, 'rb') as file:
+        digest = hashlib.sha256(file.read()).digest()
+    with file_digests_lock:
+        file_digests[key] = digest
+    return digest
+
+# Returns a hash of the parts of the install hash (see get_npm_install_hash) that npm install in dir
+# doesn't change: the node and npm versions, and the package.json, package-lock.json, and contents of
+# each package file of dir's relative dependencies (which npm install copies into node_modules, so
+# changing one of them has to make the install run again). Contents are hashed instead of
+# modification times, so that rebuilding a dependency with no changes doesn't force a reinstall.
+def get_npm_install_dependencies_hash(dir):
+    install_hash = hashlib.sha256()
+    for version in get_toolchain_versions():
+        install_hash.update(version.encode('UTF-8') + b'\0')
+    for package_dir in get_relative_dependency_dirs(dir):
+        for path in ['package.json', 'package-lock.json'] + get_package_files(package_dir):
+            full_path = os.path.join(package_dir, path)
+            install_hash.update(full_path.encode('UTF-8') + b'\0')
+            if os.path.exists(full_path):
+                install_hash.update(get_file_digest(full_path))
+    return install_hash.hexdigest()
+
+# Returns a hash of everything that determines the result of npm install in dir: the dependencies
+# hash from get_npm_install_dependencies_hash, and the package.json and package-lock.json of dir.
+def get_npm_install_hash(dir, dependencies_hash):
+    install_hash = hashlib.sha256(dependencies_hash.encode('UTF-8') + b'\0')
+    for filename in ['package.json', 'package-lock.json']:
+        path = os.path.join(dir, filename)
+        install_hash.update(path.encode('UTF-8') + b'\0')
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                install_hash.update(hashlib.sha256(file.read()).digest())
+    return install_hash.hexdigest()
+
+def read_npm_install_hash(dir):
+    try:
+        with open(os.path.join(dir, 'node_modules', npm_install_hash_filename), encoding='UTF-8') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+def remove_npm_install_hash(dir):
+    hash_filename = os.path.join(dir, 'node_modules', npm_install_hash_filename)
+    if os.path.exists(hash_filename):
+        os.remove(hash_filename)
+
+# Returns whether node_modules in dir was installed by npm_install_dir with the current install hash.
+def npm_install_is_current(dir):
+    return read_npm_install_hash(dir) == get_npm_install_hash(dir, get_npm_install_dependencies_hash(dir))
+
+# Runs npm install in dir, unless node_modules was installed by an earlier run with the same install
+# hash (and --forceInstall wasn't specified).
 def npm_install_dir(dir):
-    print('Performing npm install in dir: ' + dir)
-    subprocess.check_call(['npm', 'install', '--force'], cwd=dir)
+    hash_filename = os.path.join(dir, 'node_modules', npm_install_hash_filename)
+    # npm install can update package-lock.json (and might have done so in an earlier run whose
+    # install is now being skipped), so it is committed along with the rewritten files.
+    record_touched_paths([os.path.join(dir, 'package-lock.json')])
+    dependencies_hash = get_npm_install_dependencies_hash(dir)
+    if not force_npm_install and read_npm_install_hash(dir) == get_npm_install_hash(dir, dependencies_hash):
+        log('Skipping npm install (dependencies unchanged) in dir: ' + dir)
+        return
+    # Don't trust node_modules if this install fails partway through.
+    remove_npm_install_hash(dir)
+    log('Performing npm install in dir: ' + dir)
+    run_checked(['npm', 'install', '--force'], cwd=dir)
+    # npm install replaces the linked relativeDependencies, so the next link starts from scratch.
+    remove_link_manifest(dir)
+    # npm install can update package-lock.json, so the hash is computed afterwards.
+    os.makedirs(os.path.dirname(hash_filename), exist_ok=True)
+    write_file_atomically(hash_filename, (get_npm_install_hash(dir, dependencies_hash) + '\n').encode('UTF-8'))
+
+# Returns a map from package name to directory for dir's package.json relativeDependencies (used by
+# relative-deps and link_relative_dependencies).
+def get_relative_dependencies(dir):
+    with open(os.path.join(dir, 'package.json'), encoding='UTF-8') as file:
+        package = json.load(file)
+    return {name: os.path.realpath(os.path.join(dir, path)) for (name, path) in package.get('relativeDependencies', {}).items()}
+
+def get_relative_dependency_dirs(dir):
+    return list(get_relative_dependencies(dir).values())
+
+# The file in node_modules that records the files put there by link_relative_dependencies.
+local_link_manifest_filename = '.newVersion-links.json'
+
+# Returns whether path (relative to the package, with / separators) matches the .npmignore (or
+# .gitignore) pattern. A pattern matching a directory also matches everything in it. Like in
+# gitignore, a pattern containing a / (other than at the end) is relative to the package root, and
+# one without matches at any depth. Unlike in gitignore, * and ? can match a /.
+def ignore_pattern_matches(pattern, path):
+    dir_only = pattern.endswith('/')
+    anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/').replace('**/', '*').replace('/**', '/*')
+    parts = path.split('/')
+    for i in range(1, len(parts) if dir_only else len(parts) + 1):
+        candidate = '/'.join(parts[:i]) if anchored else parts[i - 1]
+        if fnmatch.fnmatchcase(candidate, pattern):
+            return True
+    return False
+
+# Returns the ignore patterns (in order, with their "!" prefixes) from the .npmignore in dir, or from
+# its .gitignore if it doesn't have one.
+def read_npm_ignore_patterns(dir):
+    for name in ['.npmignore', '.gitignore']:
+        filename = os.path.join(dir, name)
+        if os.path.exists(filename):
+            with open(filename, encoding='UTF-8') as file:
+                return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    return []
+
+def is_npm_ignored(patterns, path):
+    ignored = False
+    for pattern in patterns:
+        negated = pattern.startswith('!')
+        if ignore_pattern_matches(pattern.lstrip('!'), path):
+            ignored = not negated
+    return ignored
+
+# Returns the paths (relative to dir) of the files that npm pack would include in the package in
+# dir. This is an approximation of npm's rules: the package.json "files" entries (minus the files
+# matched by its "!" entries), or if there aren't any, everything not excluded by the .npmignore (or
+# .gitignore) in dir. node_modules and hidden directories are always left out, and package.json,
+# the README and LICENSE files, and the main file are always included. Unlike npm, this ignores
+# .npmignore files in subdirectories, and only handles the common ignore pattern syntax.
+def get_package_files(dir):
+    with open(os.path.join(dir, 'package.json'), encoding='UTF-8') as file:
+        package = json.load(file)
+    files = set()
+
+    def add_path(path):
+        if os.path.isdir(path):
+            for (root, dirnames, filenames) in os.walk(path):
+                dirnames[:] = [dirname for dirname in dirnames if dirname != 'node_modules' and not dirname.startswith('.')]
+                for filename in filenames:
+                    files.add(os.path.relpath(os.path.join(root, filename), dir))
+        elif os.path.isfile(path):
+            files.add(os.path.relpath(path, dir))
+
+    if 'files' not in package:
+        add_path(dir)
+        # npm never packs the ignore files themselves.
+        patterns = read_npm_ignore_patterns(dir) + ['.npmignore', '.gitignore']
+        files = {path for path in files if not is_npm_ignored(patterns, path.replace(os.sep, '/'))}
+    else:
+        for pattern in package['files']:
+            if not pattern.startswith('!'):
+                for path in glob.glob(os.path.join(glob.escape(dir), pattern), recursive=True):
+                    add_path(path)
+        negated_patterns = [pattern[1:] for pattern in package['files'] if pattern.startswith('!')]
+        files = {path for path in files if not any(ignore_pattern_matches(pattern, path.replace(os.sep, '/')) for pattern in negated_patterns)}
+    for name in os.listdir(dir):
+        if name == 'package.json' or re.match('(README|LICEN[CS]E)', name, re.IGNORECASE):
+            add_path(os.path.join(dir, name))
+    if package.get('main'):
+        add_path(os.path.join(dir, package['main']))
+    return sorted(files)
+
+def get_link_manifest_filename(dir):
+    return os.path.join(dir, 'node_modules', local_link_manifest_filename)
+
+def read_link_manifest(dir):
+    try:
+        with open(get_link_manifest_filename(dir), encoding='UTF-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def remove_link_manifest(dir):
+    if os.path.exists(get_link_manifest_filename(dir)):
+        os.remove(get_link_manifest_filename(dir))
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def link_file(source, target):
+    remove_path(target)
+    if local_link_mode == 'hardlink':
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, target)
+
+# Puts the package files of each of dir's relativeDependencies into dir's node_modules by
+# hardlinking (or copying) them, instead of packing and extracting them like relative-deps does.
+# The linked files are recorded in a manifest, so that later links only touch the files that
+# changed, and so that the links can be verified or undone.
+def link_relative_dependencies(dir):
+    dir = os.path.realpath(dir)
+    manifest = read_link_manifest(dir)
+    new_manifest = {}
+    for (name, source) in get_relative_dependencies(dir).items():
+        target_dir = os.path.join(dir, 'node_modules', name)
+        entry = manifest.get(name)
+        if entry is None or entry['source'] != source:
+            # Replace whatever npm install (or a link from somewhere else) put there.
+            remove_path(target_dir)
+            old_files = {}
+        else:
+            old_files = entry['files']
+        files = {}
+        num_linked = 0
+        for path in get_package_files(source):
+            source_path = os.path.join(source, path)
+            target_path = os.path.join(target_dir, path)
+            signature = get_file_signature(source_path)
+            if old_files.get(path) != signature or not os.path.exists(target_path) or get_file_signature(target_path) != signature:
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                link_file(source_path, target_path)
+                num_linked += 1
+            files[path] = signature
+        removed = [path for path in old_files if path not in files]
+        for path in removed:
+            remove_path(os.path.join(target_dir, path))
+        new_manifest[name] = {'source': source, 'files': files}
+        log(f'Linked {name} into {dir}: {num_linked} updated, {len(files) - num_linked} unchanged, {len(removed)} removed')
+    os.makedirs(os.path.join(dir, 'node_modules'), exist_ok=True)
+    write_file_atomically(get_link_manifest_filename(dir), (json.dumps(new_manifest, indent=2) + '\n').encode('UTF-8'))
+
+# Returns a list of the problems with the links recorded in dir's link manifest.
+def verify_relative_dependency_links(dir):
+    dir = os.path.realpath(dir)
+    problems = []
+    for (name, entry) in read_link_manifest(dir).items():
+        source = entry['source']
+        target_dir = os.path.join(dir, 'node_modules', name)
+        for (path, signature) in entry['files'].items():
+            source_path = os.path.join(source, path)
+            target_path = os.path.join(target_dir, path)
+            if not os.path.exists(source_path):
+                problems.append(f'{name}/{path}: deleted from {source}')
+            elif not os.path.exists(target_path):
+                problems.append(f'{name}/{path}: missing from node_modules')
+            elif get_file_signature(source_path) != signature:
+                problems.append(f'{name}/{path}: changed since it was linked')
+            elif get_file_signature(target_path) != signature:
+                problems.append(f'{name}/{path}: modified in node_modules')
+        if os.path.exists(source):
+            for path in get_package_files(source):
+                if path not in entry['files']:
+                    problems.append(f'{name}/{path}: added since the last link')
+    return problems
+
+def unlink_relative_dependencies(dir):
+    dir = os.path.realpath(dir)
+    for name in read_link_manifest(dir):
+        remove_path(os.path.join(dir, 'node_modules', name))
+        log(f'Removed {name} from {dir}')
+    remove_link_manifest(dir)
+    # node_modules no longer matches what npm install left there, so the next install must not be
+    # skipped.
+    remove_npm_install_hash(dir)
+
+def link_command(args):
+    dirs = [os.path.realpath(dir) for dir in args.dirs] if args.dirs else [dir for dir in get_js_dirs() if get_relative_dependencies(dir)]
+    problems = []
+    for dir in dirs:
+        if args.verify:
+            dir_problems = verify_relative_dependency_links(dir)
+            if not read_link_manifest(dir):
+                dir_problems.append('nothing is linked')
+            print(f'{dir}: ' + ('OK' if not dir_problems else f'{len(dir_problems)} problem(s)'))
+            problems.extend(f'  {dir}: {problem}' for problem in dir_problems)
+        elif args.undo:
+            unlink_relative_dependencies(dir)
+        else:
+            link_relative_dependencies(dir)
+    if problems:
+        raise Exception("Error: Links are out of date:\n" + '\n'.join(problems))
+    if args.undo:
+        print("Run npm install in the dirs to restore the published versions of the packages.")
+
+# Runs npm install in all of the given directories, up to max_npm_install_jobs at a time. The
+# relative-deps prepare script that runs during npm install builds each relative dependency, so a
+# directory is only installed once all of its relative dependencies that are also in dirs have
+# been installed.
+def npm_install_dirs(dirs):
+    graph = TaskGraph()
+    add_npm_install_tasks(graph, dirs)
+    graph.run(max_npm_install_jobs)
+
+# Adds an npm install task for each of dirs to graph, each depending on the install tasks for its
+# relative dependencies, as well as on dependencies. Returns the names of the added tasks.
+def add_npm_install_tasks(graph, dirs, dependencies = []):
+    dirs = [os.path.realpath(dir) for dir in dirs]
+    relative_dependencies = {}
+    for dir in dirs:
+        relative_dependencies[dir] = [dependency for dependency in get_relative_dependency_dirs(dir) if dependency in dirs and dependency != dir]
+    task_names = {}
+    pending = list(dirs)
+    while pending:
+        ready = [dir for dir in pending if all(dependency in task_names for dependency in relative_dependencies[dir])]
+        if not ready:
+            raise Exception("Error: Circular relativeDependencies in: " + ', '.join(pending))
+        for dir in ready:
+            pending.remove(dir)
+            task_dependencies = list(dependencies) + [task_names[dependency] for dependency in relative_dependencies[dir]]
+            task_names[dir] = graph.add('install ' + os.path.basename(dir), lambda dir=dir: npm_install_dir(dir), task_dependencies)
+    return list(task_names.values())
 
 def bumpui_command(args):
     get_versions(args)
@@ -398,26 +1865,42 @@ def bumpui_command(args):
 
 def changesamples_command(args):
     args.current_mobile = args.new_mobile
-    modify_package_json(args, os.path.join(sdk_dirs.samples, react_app_subdir))
-    modify_package_json(args, os.path.join(sdk_dirs.samples, token_server_subdir))
-    modify_samples_project_pbxproj(args)
-    modify_samples_build_gradle(args)
-    modify_sample_build_gradle(args, os.path.join(sdk_dirs.samples, 'Android/Shared/build.gradle'))
-    modify_samples_package_resolved(args)
+    prefetch_latest_versions(get_itwin_non_core_version_keys())
+    rewrites = []
+    for subdir in [react_app_subdir, token_server_subdir]:
+        dir = os.path.join(sdk_dirs.samples, subdir)
+        rewrites.append((os.path.join(dir, 'package.json'), modify_package_json, (args, dir)))
+    rewrites += get_samples_project_pbxproj_rewrites(args)
+    rewrites += get_samples_build_gradle_rewrites(args)
+    shared_build_gradle = os.path.join(sdk_dirs.samples, 'Android/Shared/build.gradle')
+    rewrites.append((shared_build_gradle, modify_sample_build_gradle, (args, shared_build_gradle)))
+    rewrites += get_samples_package_resolved_rewrites(args)
+    run_rewrites(rewrites)
 
 def bumpsamples_command(args):
     get_versions(args)
     changesamples_command(args)
-    npm_install_dir(os.path.join(sdk_dirs.samples, react_app_subdir))
-    npm_install_dir(os.path.join(sdk_dirs.samples, token_server_subdir))
-
-def dir_has_diff(dir):
-    return subprocess.call(['git', 'diff', '--quiet'], cwd=dir) != 0
+    npm_install_dirs([os.path.join(sdk_dirs.samples, react_app_subdir), os.path.join(sdk_dirs.samples, token_server_subdir)])
+
+# With paths (relative to dir), only checks those, and also counts changes that are staged.
+def dir_has_diff(dir, paths = None):
+    command = ['git', 'diff', '--quiet']
+    if paths:
+        command += ['HEAD', '--'] + paths
+    with trace_subprocess(command, dir) as span:
+        span['exit_code'] = subprocess.call(command, cwd=dir)
+    return span['exit_code'] != 0
+
+# Returns a list of (dir, has_diff) for all the dirs, checking them all at the same time.
+def get_dir_diffs():
+    dirs = list(sdk_dirs)
+    with ThreadPoolExecutor(max_workers=len(dirs)) as executor:
+        return list(zip(dirs, executor.map(dir_has_diff, dirs)))
 
 def ensure_all_dirs_have_diffs():
     should_throw = False
-    for dir in sdk_dirs:
-        if not dir_has_diff(dir):
+    for (dir, has_diff) in get_dir_diffs():
+        if not has_diff:
             print("No diffs in dir: " + dir)
             should_throw = True
     if should_throw:
@@ -425,21 +1908,53 @@ def ensure_all_dirs_have_diffs():
 
 def ensure_no_dirs_have_diffs():
     should_throw = False
-    for dir in sdk_dirs:
-        if dir_has_diff(dir):
+    for (dir, has_diff) in get_dir_diffs():
+        if has_diff:
             print("Diffs in dir: " + dir)
             should_throw = True
     if should_throw:
         raise Exception("Error: Diffs are not allowed")
 
+# Returns the tracked files in dir (relative to it) that differ from HEAD, limited to paths if any
+# are given.
+def get_changed_paths(dir, paths = []):
+    output = get_quiet_output(['git', 'diff', '--name-only', '--relative', 'HEAD', '--'] + paths, dir)
+    if output is None:
+        raise Exception("Error: Unable to list the changed files in dir: " + dir)
+    return output.splitlines()
+
+# Returns the untracked files in dir (relative to it) that aren't ignored.
+def get_untracked_paths(dir):
+    output = get_quiet_output(['git', 'ls-files', '--others', '--exclude-standard'], dir)
+    if output is None:
+        raise Exception("Error: Unable to list the untracked files in dir: " + dir)
+    return output.splitlines()
+
 def commit_dir(args, dir):
-    print("Committing in dir: " + dir)
-    if dir_has_diff(dir):
-        subprocess.check_call(['git', 'checkout', git_branch], cwd=dir)
-        subprocess.check_call(['git', 'add', '.'], cwd=dir)
-        subprocess.check_call(['git', 'commit', '-m', 'Update version to ' + args.new_mobile], cwd=dir)
+    # The touched paths are real paths, so dir has to be one too for them to be found in it.
+    dir = os.path.realpath(dir)
+    log("Committing in dir: " + dir)
+    paths = get_touched_paths(dir)
+    if not paths:
+        # Nothing was recorded as written in dir (for example, when the changes were made by an
+        # earlier command), so commit everything.
+        if dir_has_diff(dir):
+            run_checked(['git', 'checkout', git_branch], cwd=dir)
+            run_checked(['git', 'add', '.'], cwd=dir)
+            run_checked(['git', 'commit', '-m', 'Update version to ' + args.new_mobile], cwd=dir)
+        else:
+            log("Nothing to commit.")
+        return
+    changed_paths = get_changed_paths(dir, paths)
+    unexpected_paths = [path for path in get_changed_paths(dir) if path not in changed_paths] + get_untracked_paths(dir)
+    if unexpected_paths:
+        log(f"Warning: Not committing unexpected changes in dir: {dir}\n  " + '\n  '.join(unexpected_paths))
+    if changed_paths:
+        run_checked(['git', 'checkout', git_branch], cwd=dir)
+        # With paths, git commit commits only those files, whatever else is in the index.
+        run_checked(['git', 'commit', '-m', 'Update version to ' + args.new_mobile, '--'] + changed_paths, cwd=dir)
     else:
-        print("Nothing to commit.")
+        log("Nothing to commit.")
 
 def get_xcodeproj_dirs():
     xcodeproj_dirs = []
@@ -450,24 +1965,58 @@ def get_xcodeproj_dirs():
         xcodeproj_dirs.append(os.path.join(sdk_dirs.samples, 'ReactNative', sample_name, 'ios', sample_name + '.xcodeproj'))
     return xcodeproj_dirs
 
-def modify_samples_project_pbxproj(args):
-    for dir in get_xcodeproj_dirs():
-        modify_project_pbxproj(args, os.path.join(dir, 'project.pbxproj'))
+# Rewrites for run_rewrites are (filename, function, function_args) tuples. The function must
+# update filename using the active rewrite transaction, and check its own replacement counts.
+def get_samples_project_pbxproj_rewrites(args):
+    filenames = [os.path.join(dir, 'project.pbxproj') for dir in get_xcodeproj_dirs()]
+    return [(filename, modify_project_pbxproj, (args, filename)) for filename in filenames]
 
 def skip_commit_id(args):
     return hasattr(args, 'skip_commit_id') and args.skip_commit_id
 
-def modify_samples_package_resolved(args):
+def get_samples_package_resolved_rewrites(args):
     if not hasattr(args, 'new_commit_id') and not skip_commit_id(args):
         args.new_commit_id = get_last_commit_id(sdk_dirs.sdk_ios, args.new_mobile)
-    for dir in get_xcodeproj_dirs():
-        modify_package_resolved(args, os.path.join(dir, 'project.xcworkspace/xcshareddata/swiftpm/Package.resolved'))
+    filenames = [os.path.join(dir, 'project.xcworkspace/xcshareddata/swiftpm/Package.resolved') for dir in get_xcodeproj_dirs()]
+    return [(filename, modify_package_resolved, (args, filename)) for filename in filenames]
 
-def modify_samples_build_gradle(args):
-    for sample_name in android_sample_names:
-        modify_sample_build_gradle(args, os.path.join(sdk_dirs.samples, 'Android', sample_name, 'app/build.gradle'))
-    for sample_name in react_native_sample_names:
-        modify_sample_build_gradle(args, os.path.join(sdk_dirs.samples, 'ReactNative', sample_name, 'android', 'app/build.gradle'))
+def get_samples_build_gradle_rewrites(args):
+    filenames = [os.path.join(sdk_dirs.samples, 'Android', sample_name, 'app/build.gradle') for sample_name in android_sample_names]
+    filenames += [os.path.join(sdk_dirs.samples, 'ReactNative', sample_name, 'android', 'app/build.gradle') for sample_name in react_native_sample_names]
+    return [(filename, modify_sample_build_gradle, (args, filename)) for filename in filenames]
+
+# Runs all the rewrites in one rewrite transaction, several at a time. If any of them fail, none of
+# the files are modified. Otherwise, prints which files changed and how long each rewrite took.
+def run_rewrites(rewrites):
+    timings = {}
+
+    def run(filename, function, function_args):
+        start = time.perf_counter()
+        try:
+            function(*function_args)
+        finally:
+            timings[filename] = time.perf_counter() - start
+
+    errors = []
+    with rewrite_transaction() as transaction:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_rewrite_workers, len(rewrites)))) as executor:
+            futures = [(filename, executor.submit(run, filename, function, function_args)) for (filename, function, function_args) in rewrites]
+            for (filename, future) in futures:
+                try:
+                    future.result()
+                except Exception as error:
+                    errors.append(f'{os.path.realpath(filename)}: {error}')
+        if errors:
+            raise Exception("Error: Rewrites failed:\n  " + '\n  '.join(errors))
+        changed_files = set(transaction.changed_files())
+    num_changed = 0
+    lines = []
+    for (filename, _, _) in rewrites:
+        changed = os.path.realpath(filename) in changed_files
+        num_changed += changed
+        lines.append(f'  {"changed" if changed else "unchanged":<9}  {timings[filename] * 1000:6.1f} ms  {os.path.relpath(os.path.realpath(filename), sdk_dirs.parent_dir)}')
+    print(f'Rewrote {num_changed} of {len(rewrites)} file(s):')
+    print('\n'.join(lines))
 
 def populate_mobile_versions(args, current = False):
     args.current_mobile = get_last_release()
@@ -484,123 +2033,418 @@ def lint_dir(dir):
     # Updated versions of dependent libraries can result in lint errors due to deprecation. Perform
     # a lint run to verify that that has not happened.
     dir = os.path.realpath(dir)
-    print("Linting in dir: " + dir)
-    subprocess.check_call(['npm', 'run', 'lint'], cwd=dir)
+    log("Linting in dir: " + dir)
+    run_checked(['npm', 'run', 'lint'], cwd=dir)
 
 def push_dir(dir):
     dir = os.path.realpath(dir)
-    print("Pushing in dir: " + dir)
-    subprocess.check_call(['git', 'push', get_repo(dir)], cwd=dir)
+    log("Pushing in dir: " + dir)
+    run_checked(['git', 'push', get_repo(dir)], cwd=dir)
 
-def release_dir(args, dir):
-    dir = os.path.realpath(dir)
-    print("Releasing in dir: " + dir)
+# Fills in the release title and notes (if they weren't specified) before any release_dir tasks
+# start, so that they don't race to do it.
+def populate_release_text(args):
     if not args.title:
         args.title = 'Release ' + args.new_mobile
     if not args.notes:
         itwin_version = get_latest_itwin_version()
         args.notes = 'Release ' + args.new_mobile + ' on iTwin ' + itwin_version + ''
-    subprocess.check_call(['git', 'checkout', git_branch], cwd=dir)
-    subprocess.check_call(['git', 'pull'], cwd=dir)
-    subprocess.check_call(['git', 'tag', args.new_mobile], cwd=dir)
-    subprocess.check_call(['git', 'push', get_repo(dir), args.new_mobile], cwd=dir)
-    subprocess.check_call([
-        'gh', 'release',
-        'create', args.new_mobile,
-        '--target', git_branch,
-        '--title', args.title,
-        '--notes', args.notes,
-        ], cwd=dir)
-    subprocess.check_call(['git', 'pull'], cwd=dir)
-    if dir.endswith('mobile-sdk-ios'):
-        release_upload(args, dir, 'itwin-mobile-sdk.podspec')
-        release_upload(args, dir, 'AsyncLocationKit.podspec')
+
+# Runs command in dir without showing its output, and returns its output, or None if it fails.
+def get_quiet_output(command, dir):
+    with trace_subprocess(command, dir) as span:
+        process = subprocess.run(command, cwd=dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        span['exit_code'] = process.returncode
+    return process.stdout if process.returncode == 0 else None
+
+def tag_exists(dir, tag):
+    invalidate_git_ref_index(dir)
+    return get_git_ref_index(dir).commit_id(tag) is not None
+
+def release_exists(dir, tag):
+    return get_quiet_output(['gh', 'release', 'view', tag, '--json', 'tagName'], dir) is not None
+
+def release_has_asset(dir, tag, filename):
+    output = get_quiet_output(['gh', 'release', 'view', tag, '--json', 'assets', '--jq', '.assets[].name'], dir)
+    return output is not None and filename in output.splitlines()
+
+# Returns True if git_branch in the GitHub repo for dir is at the HEAD of dir. push_dir pushes to
+# the repo's URL, which doesn't update the remote-tracking branch, so the repo itself is checked.
+def branch_is_pushed(dir):
+    head = get_quiet_output(['git', 'rev-parse', 'HEAD'], dir)
+    remote = get_quiet_output(['git', 'ls-remote', get_repo(dir), 'refs/heads/' + git_branch], dir)
+    return head is not None and remote is not None and remote.split('\t')[0] == head.strip()
+
+def release_dir(args, dir):
+    dir = os.path.realpath(dir)
+    log("Releasing in dir: " + dir)
+    populate_release_text(args)
+    run_checked(['git', 'checkout', git_branch], cwd=dir)
+    run_checked(['git', 'pull'], cwd=dir)
+    if tag_exists(dir, args.new_mobile):
+        log("Tag already exists: " + args.new_mobile)
+    else:
+        run_checked(['git', 'tag', args.new_mobile], cwd=dir)
+        invalidate_git_ref_index(dir)
+    run_checked(['git', 'push', get_repo(dir), args.new_mobile], cwd=dir)
+    if release_exists(dir, args.new_mobile):
+        log("Release already exists: " + args.new_mobile)
+    else:
+        run_checked([
+            'gh', 'release',
+            'create', args.new_mobile,
+            '--target', git_branch,
+            '--title', args.title,
+            '--notes', args.notes,
+            ], cwd=dir)
+    run_checked(['git', 'pull'], cwd=dir)
 
 def release_upload(args, dir, filename):
-    print("Uploading in dir: {} file: {}".format(dir, filename))
-    subprocess.check_call(['gh', 'release', 'upload', args.new_mobile, filename], cwd=dir)
-
-def push_command(args, dir, current = False):
-    populate_mobile_versions(args, current)
-    print("Pushing version: " + args.new_mobile + "\nin dir: " + dir)
-    commit_dir(args, dir)
-    push_dir(dir)
-
-def push1_command(args):
-    # Make sure mobile-sdk-core lint passes before pushing any changes.
-    lint_dir(sdk_dirs.sdk_core)
-    push_command(args, sdk_dirs.sdk_ios)
-    push_command(args, sdk_dirs.sdk_android)
-    push_command(args, sdk_dirs.sdk_core)
-
-def push2_command(args):
-    lint_dir(sdk_dirs.ui_react)
-    push_command(args, sdk_dirs.ui_react, True)
-
-def push3_command(args):
-    lint_dir(os.path.join(sdk_dirs.samples, react_app_subdir))
-    push_command(args, sdk_dirs.samples, True)
+    log("Uploading in dir: {} file: {}".format(dir, filename))
+    run_checked(['gh', 'release', 'upload', args.new_mobile, filename], cwd=dir)
+
+# Adds tasks to graph that release dir, plus tasks to upload the podspecs for mobile-sdk-ios.
+# Returns the names of all the added tasks.
+def add_release_tasks(graph, args, dir, dependencies = []):
+    release = graph.add(
+        'release ' + os.path.basename(dir),
+        lambda: release_dir(args, dir),
+        dependencies,
+        lambda: tag_exists(dir, args.new_mobile) and release_exists(dir, args.new_mobile)
+    )
+    tasks = [release]
+    if dir == sdk_dirs.sdk_ios:
+        for filename in ['itwin-mobile-sdk.podspec', 'AsyncLocationKit.podspec']:
+            tasks.append(graph.add(
+                'upload ' + filename,
+                lambda filename=filename: release_upload(args, dir, filename),
+                [release],
+                lambda filename=filename: release_has_asset(dir, args.new_mobile, filename)
+            ))
+    return tasks
+
+# Adds tasks to graph that lint lint_dir_path, then commit and push each of dirs. Returns the names
+# of the push tasks.
+def add_push_tasks(graph, args, lint_dir_path, dirs, dependencies = []):
+    # Make sure lint passes before committing or pushing any changes.
+    lint = graph.add('lint ' + os.path.basename(lint_dir_path), lambda: lint_dir(lint_dir_path), dependencies)
+    pushes = []
+    for dir in dirs:
+        name = os.path.basename(dir)
+        commit = graph.add('commit ' + name, lambda dir=dir: commit_dir(args, dir), [lint], lambda dir=dir: not dir_has_diff(dir, get_touched_paths(dir)))
+        pushes.append(graph.add('push ' + name, lambda dir=dir: push_dir(dir), [commit], lambda dir=dir: branch_is_pushed(dir)))
+    return pushes
+
+# Returns why the stage1 or stage2 journal with the given inputs is out of date, or None. Those
+# stages run before the new release is tagged, so the journal is out of date once it has been, or
+# once any other release has been made since the journal was started.
+def get_stale_change_journal_reason(inputs):
+    new_mobile = inputs.get('new_mobile')
+    if new_mobile and tag_exists(sdk_dirs.sdk_ios, new_mobile):
+        return f'{new_mobile} has already been tagged'
+    last_release = get_last_release()
+    if inputs.get('current_mobile') != last_release:
+        return f'it was started after {inputs.get("current_mobile")}, but the last release is {last_release}'
+    return None
+
+# Returns why the stage3 journal with the given inputs is out of date, or None. stage3 tags the new
+# release, so the journal is only out of date once another release has been made, or once
+# mobile-samples (the last thing stage3 releases) has been released.
+def get_stale_release_journal_reason(inputs):
+    new_mobile = inputs.get('new_mobile')
+    last_release = get_last_release()
+    if last_release not in [inputs.get('current_mobile'), new_mobile]:
+        return f'it was started for {new_mobile}, but the last release is {last_release}'
+    if new_mobile and release_exists(sdk_dirs.samples, new_mobile):
+        return f'{new_mobile} has already been released'
+    return None
+
+# Returns a verify function for a task that changes files in dirs, which are then committed by
+# add_push_tasks. The changes are still there if the files touched in each dir still differ from
+# HEAD, or if the dir has already been committed.
+def get_changes_verify(graph, dirs):
+    return lambda: all(graph.journal.is_completed('commit ' + os.path.basename(dir)) or dir_has_diff(dir, get_touched_paths(dir)) for dir in dirs)
 
 def show_node_version():
-    node_version = subprocess.check_output(['node', '--version'], stderr=subprocess.STDOUT, text=True)
-    print(f'Using node version: {node_version}', end='')
-    npm_version = subprocess.check_output(['npm', '--version'], stderr=subprocess.STDOUT, text=True)
-    print(f'Using npm version: {npm_version}', end='')
+    (node_version, npm_version) = get_toolchain_versions()
+    print(f'Using node version: {node_version}')
+    print(f'Using npm version: {npm_version}')
 
 def show_python_version():
+    import platform
     print(f'Using python version: {platform.python_version()}')
 
 def stage1_command(args):
     show_python_version()
     show_node_version()
-    bump_command(args)
-    push1_command(args)
+
+    def resolve():
+        if not args.force:
+            ensure_no_dirs_have_diffs()
+        get_versions(args)
+
+    def build_graph(graph):
+        # The dirs are expected to have diffs from here on.
+        args.force = True
+        dirs = [sdk_dirs.sdk_ios, sdk_dirs.sdk_android, sdk_dirs.sdk_core]
+        change = graph.add('change', lambda: change_command(args), [], get_changes_verify(graph, dirs))
+        install = graph.add('install mobile-sdk-core', lambda: npm_install_dir(sdk_dirs.sdk_core), [change], lambda: npm_install_is_current(sdk_dirs.sdk_core))
+        add_push_tasks(graph, args, sdk_dirs.sdk_core, dirs, [install])
+
+    run_stage(args, 'stage1', resolve, build_graph, get_stale_change_journal_reason)
 
 def stage2_command(args):
     show_python_version()
     show_node_version()
-    bumpui_command(args)
-    push2_command(args)
+
+    def build_graph(graph):
+        change = graph.add('change ui', lambda: changeui_command(args), [], get_changes_verify(graph, [sdk_dirs.ui_react]))
+        install = graph.add('install mobile-ui-react', lambda: npm_install_dir(sdk_dirs.ui_react), [change], lambda: npm_install_is_current(sdk_dirs.ui_react))
+        add_push_tasks(graph, args, sdk_dirs.ui_react, [sdk_dirs.ui_react], [install])
+
+    run_stage(args, 'stage2', lambda: get_versions(args), build_graph, get_stale_change_journal_reason)
 
 def stage3_command(args):
     show_python_version()
     show_node_version()
+
+    def resolve():
+        populate_mobile_versions(args)
+        populate_release_text(args)
+
+    def build_graph(graph):
+        # iTiwn/mobile-sdk-ios must be released before we can update the samples to point to it. The
+        # other three packages are released at the same time, and the samples are only released once
+        # everything else has been.
+        releases = []
+        for dir in [sdk_dirs.sdk_ios, sdk_dirs.sdk_android, sdk_dirs.sdk_core, sdk_dirs.ui_react]:
+            releases.extend(add_release_tasks(graph, args, dir))
+        bumpsamples = graph.add('bump mobile-samples', lambda: bumpsamples_command(args), ['release mobile-sdk-ios'], get_changes_verify(graph, [sdk_dirs.samples]))
+        pushes = add_push_tasks(graph, args, os.path.join(sdk_dirs.samples, react_app_subdir), [sdk_dirs.samples], [bumpsamples])
+        add_release_tasks(graph, args, sdk_dirs.samples, releases + pushes)
+
+    run_stage(args, 'stage3', resolve, build_graph, get_stale_release_journal_reason)
+
+# Waits until version of each of the given packages has been published to the npm registry. Polls
+# use conditional requests, so a packument is only downloaded again once it has changed. The time
+# between polls doubles (with random jitter, so that several watchers don't poll in lockstep) from
+# interval up to max_interval seconds. Raises an exception if the packages still haven't all been
+# published after deadline seconds.
+def wait_for_published(packages, version, interval, max_interval, deadline):
+    end_time = time.monotonic() + deadline
+    validators = {}
+    waiting = list(packages)
+    while True:
+        for package in list(waiting):
+            try:
+                (packument, validators[package]) = get_registry_client(package).fetch_packument(package, validators.get(package))
+            except Exception as error:
+                # Registry hiccups shouldn't end a long wait; just try again after the next delay.
+                log(f"Checking {package} failed: {error}")
+                continue
+            if packument is not None and version in packument.get('versions', {}):
+                log(f"Published: {package}@{version}")
+                waiting.remove(package)
+        if not waiting:
+            return
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f"Error: Timed out waiting for {', '.join(package + '@' + version for package in waiting)} to be published.")
+        delay = min(remaining, interval / 2 + random.uniform(0, interval / 2))
+        log(f"Waiting for {', '.join(waiting)} (checking again in {delay:.0f} s)")
+        time.sleep(delay)
+        interval = min(max_interval, interval * 2)
+
+def watch_command(args):
+    stage_commands = {
+        'stage2': stage2_command,
+        'stage3': stage3_command,
+    }
     populate_mobile_versions(args)
-    # iTiwn/mobile-sdk-ios must be released before we can update the samples to point to it.
-    # Release the three main packages in a row, then update and release the samples.
-    release_dir(args, sdk_dirs.sdk_ios)
-    release_dir(args, sdk_dirs.sdk_android)
-    release_dir(args, sdk_dirs.sdk_core)
-    release_dir(args, sdk_dirs.ui_react)
-    bumpsamples_command(args)
-    push3_command(args)
-    release_dir(args, sdk_dirs.samples)
+    packages = watch_stage_packages[args.stage]
+    print(f"Watching {get_registry_client(packages[0]).registry_url} for version {args.new_mobile} of {', '.join(packages)}")
+    with trace_span(f'wait for {args.new_mobile}', 'watch'):
+        wait_for_published(packages, args.new_mobile, args.interval, max(args.interval, args.max_interval), args.deadline * 60)
+    print(f"Starting {args.stage}")
+    stage_commands[args.stage](args)
 
 def changesamplestest_command(args):
     args.new_commit_id = 'new_commit_id'
     args.new_add_on_commit_id = 'new_add_on_commit_id'
     args.new_mobile = 'new_mobile'
     args.new_add_on = 'new_add_on'
-    modify_samples_package_resolved(args)
-    modify_samples_project_pbxproj(args)
-    modify_samples_build_gradle(args)
+    run_rewrites(get_samples_package_resolved_rewrites(args) + get_samples_project_pbxproj_rewrites(args) + get_samples_build_gradle_rewrites(args))
 
 def test_command(args):
     show_python_version()
     show_node_version()
     get_versions(args, True)
-    change_command(args)
-    changeui_command(args)
-    changesamples_command(args)
-    npm_install_dir(sdk_dirs.sdk_core)
-    npm_install_dir(sdk_dirs.ui_react)
-    npm_install_dir(os.path.join(sdk_dirs.samples, react_app_subdir))
-    npm_install_dir(os.path.join(sdk_dirs.samples, token_server_subdir))
+    with rewrite_transaction():
+        change_command(args)
+        changeui_command(args)
+        changesamples_command(args)
+    npm_install_dirs(get_js_dirs())
     npm_build_dir(sdk_dirs.sdk_core)
     npm_build_dir(sdk_dirs.ui_react, True)
     npm_build_dir(os.path.join(sdk_dirs.samples, react_app_subdir), True)
     npm_build_dir(os.path.join(sdk_dirs.samples, token_server_subdir))
 
+def get_matrix_worktrees_dir(args):
+    return os.path.realpath(args.worktrees) if args.worktrees else os.path.join(sdk_dirs.parent_dir, '.newVersion-matrix')
+
+# Returns (iTwin version, add-on version, add-on commit ID) for each of the matrix command's version
+# arguments. Each one is ITWIN[:ADD_ON], where ITWIN can be a prefix (such as 4.8) for the latest
+# matching release.
+def resolve_matrix_versions(version_args):
+    def resolve(version_arg):
+        (itwin_version, _, add_on_version) = version_arg.partition(':')
+        if not re.fullmatch('[0-9]+\\.[0-9]+\\.[0-9]+.*', itwin_version):
+            itwin_version = get_latest_version(itwin_version_package, itwin_version)
+        if not add_on_version:
+            add_on_version = get_latest_native_version(itwin_version)
+            if not add_on_version:
+                raise Exception("Error: Unable to determine the add-on version for iTwin " + itwin_version)
+        add_on_commit_id = get_last_remote_commit_id('https://github.com/iTwin/mobile-native-ios.git', add_on_version)
+        if not add_on_commit_id:
+            raise Exception("Error: Unable to find the commit ID of mobile-native-ios " + add_on_version)
+        return (itwin_version, add_on_version, add_on_commit_id)
+
+    return run_concurrently(*[lambda version_arg=version_arg: resolve(version_arg) for version_arg in version_args])
+
+# Makes worktree_dir a detached worktree of repo_dir at its current HEAD. An existing worktree is
+# reset instead of being recreated, so that its node_modules (which is ignored by git) can be reused.
+def prepare_matrix_worktree(repo_dir, worktree_dir):
+    commit_id = get_quiet_output(['git', 'rev-parse', 'HEAD'], repo_dir)
+    if commit_id is None:
+        raise Exception("Error: Unable to get the HEAD commit of dir: " + repo_dir)
+    if os.path.exists(worktree_dir):
+        run_checked(['git', 'checkout', '--quiet', '--force', '--detach', commit_id.strip()], cwd=worktree_dir)
+    else:
+        run_checked(['git', 'worktree', 'add', '--quiet', '--force', '--detach', worktree_dir, commit_id.strip()], cwd=repo_dir)
+
+# Creates (or resets) a set of worktrees (one for each of the repositories) in each of set_dirs.
+# The repositories are done at the same time, but each repository's worktrees are added one at a
+# time, since git locks the repository while adding one.
+def prepare_matrix_worktree_sets(set_dirs):
+    def prepare(repo_dir):
+        for set_dir in set_dirs:
+            prepare_matrix_worktree(repo_dir, os.path.join(set_dir, os.path.basename(repo_dir)))
+
+    run_concurrently(*[lambda repo_dir=repo_dir: prepare(repo_dir) for repo_dir in sdk_dirs])
+
+# Runs the test command for one matrix entry in its own worktree set (in a separate process, since
+# sdk_dirs is global), sending its output to a log file. The versions are passed in the environment,
+# since it takes precedence over the command line. Returns (passed, seconds, log filename).
+def run_matrix_test(args, set_dir, itwin_version, add_on_version, add_on_commit_id):
+    command = [sys.executable, os.path.realpath(__file__), '-d', set_dir]
+    if args.no_cache:
+        command.append('--noCache')
+    if args.force_install:
+        command.append('--forceInstall')
+    if args.registry:
+        command += ['--registry', args.registry]
+    command.append('test')
+    env = dict(os.environ, ITM_NEW_ITWIN=itwin_version, ITM_NEW_ADD_ON=add_on_version, ITM_NEW_ADD_ON_COMMIT_ID=add_on_commit_id)
+    log_filename = os.path.join(set_dir, 'matrix.log')
+    log(f"Testing iTwin {itwin_version} (add-on {add_on_version}) in dir: {set_dir}")
+    start = time.perf_counter()
+    with open(log_filename, 'w', encoding='UTF-8') as log_file:
+        with trace_subprocess(command, set_dir) as span:
+            span['exit_code'] = subprocess.call(command, cwd=set_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - start
+    log(f"{'Passed' if span['exit_code'] == 0 else 'Failed'}: iTwin {itwin_version} ({seconds:.1f} s)")
+    return (span['exit_code'] == 0, seconds, log_filename)
+
+# Tests each of the given iTwin versions in its own set of git worktrees (of the current HEAD of each
+# repository), several at a time, leaving the real checkouts untouched.
+def matrix_command(args):
+    show_python_version()
+    show_node_version()
+    version_args = args.versions or [search.replace('\\', '').rstrip('.') for search in itwin_base_version_search_list]
+    entries = list(dict.fromkeys(resolve_matrix_versions(version_args)))
+    worktrees_dir = get_matrix_worktrees_dir(args)
+    # Entries can share an iTwin version (with different add-on versions), so both name the set.
+    set_dirs = [os.path.join(worktrees_dir, f'{itwin_version}_{add_on_version}') for (itwin_version, add_on_version, _) in entries]
+    print(f"Preparing {len(set_dirs)} worktree set(s) in dir: {worktrees_dir}")
+    prepare_matrix_worktree_sets(set_dirs)
+    jobs = args.jobs or max(1, (os.cpu_count() or 1) // matrix_cpus_per_job)
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(entries)))) as executor:
+        futures = [executor.submit(run_matrix_test, args, set_dir, *entry) for (set_dir, entry) in zip(set_dirs, entries)]
+    results = [future.result() for future in futures]
+    print(f'{"iTwin":<16}{"Add-on":<16}{"Result":<8}{"Time":>10}  Log')
+    for ((itwin_version, add_on_version, _), (passed, seconds, log_filename)) in zip(entries, results):
+        print(f'{itwin_version:<16}{add_on_version:<16}{"passed" if passed else "FAILED":<8}{seconds:>8.1f} s  {os.path.relpath(log_filename)}')
+    num_failed = sum(not passed for (passed, _, _) in results)
+    if num_failed:
+        raise Exception(f"Error: {num_failed} of {len(results)} iTwin version(s) failed.")
+
+def get_bootstrap_url(base_url, dir):
+    if '://' not in base_url and os.path.isdir(base_url):
+        # git ignores --depth and --filter when cloning from a plain path.
+        base_url = 'file://' + os.path.realpath(base_url)
+    return f"{base_url.rstrip('/')}/{os.path.basename(dir)}.git"
+
+# Returns the branch checked out in dir, or None if it has a detached HEAD (or isn't a repository).
+def get_current_branch(dir):
+    output = get_quiet_output(['git', 'symbolic-ref', '--quiet', '--short', 'HEAD'], dir)
+    return output.strip() if output else None
+
+# Clones dir from args.base_url, or updates it if it has already been cloned. Clones are partial
+# (commits and trees, with file contents downloaded as they are checked out), or shallow with
+# --depth, and borrow objects from the repository of the same name in args.reference, if any.
+# Returns 'cloned' or 'updated'.
+def bootstrap_dir(args, dir):
+    if os.path.isdir(os.path.join(dir, '.git')):
+        log("Updating dir: " + dir)
+        run_checked(['git', 'fetch', '--tags', 'origin'], cwd=dir)
+        run_checked(['git', 'checkout', git_branch], cwd=dir)
+        run_checked(['git', 'merge', '--ff-only', 'origin/' + git_branch], cwd=dir)
+        return 'updated'
+    if os.path.exists(dir) and os.listdir(dir):
+        raise Exception("Error: Not a git repository: " + dir)
+    url = get_bootstrap_url(args.base_url, dir)
+    log(f"Cloning {url} into dir: {dir}")
+    command = ['git', 'clone', '--branch', git_branch]
+    if args.depth:
+        command += ['--depth', str(args.depth), '--no-single-branch']
+    else:
+        command.append('--filter=blob:none')
+    if args.reference:
+        reference = os.path.realpath(os.path.join(args.reference, os.path.basename(dir)))
+        if not os.path.isdir(reference):
+            reference += '.git'
+        command += ['--reference-if-able', reference]
+    run_checked(command + [url, dir])
+    if args.depth:
+        # A shallow clone only has the tags on the commits it fetched, but get_last_release needs all
+        # of the release tags. The fetch uses the same depth so that it doesn't shorten the history
+        # of the branch.
+        run_checked(['git', 'fetch', '--tags', f'--depth={args.depth}', 'origin'], cwd=dir)
+    return 'cloned'
+
+def bootstrap_command(args):
+    os.makedirs(sdk_dirs.parent_dir, exist_ok=True)
+    results = {}
+
+    def bootstrap(dir):
+        start = time.perf_counter()
+        action = bootstrap_dir(args, dir)
+        results[dir] = (action, time.perf_counter() - start)
+
+    graph = TaskGraph()
+    for dir in sdk_dirs:
+        graph.add('bootstrap ' + os.path.basename(dir), lambda dir=dir: bootstrap(dir))
+    graph.run(len(sdk_dirs.dirs))
+    wrong_branches = []
+    for dir in sdk_dirs:
+        (action, seconds) = results[dir]
+        branch = get_current_branch(dir)
+        if branch != git_branch:
+            wrong_branches.append(f'{dir} ({branch or "detached HEAD"})')
+        print(f'{os.path.basename(dir):<20}{action:<9}{seconds:>8.1f} s  {branch or "detached HEAD"}')
+    if wrong_branches:
+        raise Exception(f"Error: {git_branch} is not checked out in: " + ', '.join(wrong_branches))
+
 def checkversions_command(args):
     get_versions(args)
     print("-------------------------------------------------------------------------------")
@@ -612,6 +2456,82 @@ def checkversions_command(args):
     print("new_add_on_commit_id: " + args.new_add_on_commit_id)
     get_itwin_non_core_tuples()
 
+# The args attributes that are recorded in a plan file.
+plan_version_names = [
+    'current_mobile',
+    'new_mobile',
+    'new_itwin',
+    'new_add_on',
+    'new_add_on_commit_id',
+    'new_commit_id',
+]
+# The args attributes that are recorded as the inputs of a stage in its journal.
+journal_input_names = plan_version_names + ['title', 'notes']
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+def plan_command(args):
+    if not args.force:
+        ensure_no_dirs_have_diffs()
+        args.force = True
+    get_versions(args, args.current)
+    if args.current:
+        args.skip_commit_id = True
+    with rewrite_transaction(True) as transaction:
+        if args.scope in ['sdk', 'all']:
+            change_command(args)
+        if args.scope in ['ui', 'all']:
+            changeui_command(args)
+        if args.scope in ['samples', 'all']:
+            changesamples_command(args)
+    files = []
+    for filename in transaction.changed_files():
+        content = transaction.contents[filename]
+        files.append({
+            'path': os.path.relpath(filename, sdk_dirs.parent_dir),
+            'sha256': sha256_hex(transaction.original_data[filename]),
+            'new_sha256': sha256_hex(content.encode('UTF-8')),
+            'content': content,
+        })
+    plan = {
+        'plan_format': 1,
+        'scope': args.scope,
+        'versions': {name: getattr(args, name, None) for name in plan_version_names},
+        'files': files,
+    }
+    output = os.path.realpath(args.output)
+    write_file_atomically(output, (json.dumps(plan, indent=2) + '\n').encode('UTF-8'))
+    print(f"Wrote plan with {len(files)} file change(s) to: {output}")
+
+def apply_command(args):
+    with open(args.plan, encoding='UTF-8') as file:
+        plan = json.load(file)
+    if plan.get('plan_format') != 1:
+        raise Exception("Error: Unsupported plan file: " + args.plan)
+    for (name, value) in plan['versions'].items():
+        if value:
+            print(f"{name}: {value}")
+    changed = []
+    with rewrite_transaction() as transaction:
+        for entry in plan['files']:
+            filename = os.path.join(sdk_dirs.parent_dir, entry['path'])
+            if not os.path.exists(filename):
+                changed.append(entry['path'])
+                continue
+            with open(filename, 'rb') as file:
+                file_hash = sha256_hex(file.read())
+            if file_hash == entry['new_sha256']:
+                print("Already up to date: " + filename)
+            elif file_hash != entry['sha256']:
+                changed.append(entry['path'])
+            else:
+                print("Applying: " + filename)
+                transaction.read(filename)
+                transaction.write(filename, entry['content'])
+        if changed:
+            raise Exception("Error: Files changed since the plan was made:\n  " + '\n  '.join(changed))
+
 def fetch_arg_from_environment(args, env_name):
     value = os.getenv(env_name)
     if not value is None:
@@ -624,19 +2544,84 @@ def process_environment(args):
     fetch_arg_from_environment(args, 'ITM_NEW_ADD_ON')
     fetch_arg_from_environment(args, 'ITM_NEW_ADD_ON_COMMIT_ID')
 
+# The tags in a git repository (local or remote), parsed from the output of a single for-each-ref
+# or ls-remote call so that any number of tag queries can be answered without running git again.
+class GitRefIndex:
+    def __init__(self):
+        # Tag name -> commit ID. Annotated tags are peeled to the commit they point to.
+        self.commit_ids = {}
+        # Version prefix (for example '0.22.') -> highest patch number of a tag with that prefix.
+        self.highest_patches = {}
+
+    def add_tag(self, tag, commit_id):
+        self.commit_ids[tag] = commit_id
+        match = re.fullmatch('([0-9]+\\.[0-9]+\\.)([0-9]+)', tag)
+        if match:
+            (prefix, patch) = (match.group(1), int(match.group(2)))
+            if patch > self.highest_patches.get(prefix, -1):
+                self.highest_patches[prefix] = patch
+
+    def highest_patch(self, prefix):
+        return self.highest_patches.get(prefix)
+
+    def commit_id(self, tag):
+        return self.commit_ids.get(tag)
+
+def load_local_git_ref_index(dir):
+    command = ['git', 'for-each-ref', '--format=%(refname) %(objectname) %(*objectname)', 'refs/tags']
+    with trace_subprocess(command, dir):
+        results = subprocess.check_output(command, cwd=dir, encoding='UTF-8')
+    index = GitRefIndex()
+    for line in results.splitlines():
+        (ref, object_id, peeled_id) = (line.split(' ') + ['', ''])[:3]
+        index.add_tag(ref[len('refs/tags/'):], peeled_id or object_id)
+    return index
+
+def load_remote_git_ref_index(repo):
+    command = ['git', 'ls-remote', '--tags', repo]
+    with trace_subprocess(command):
+        results = subprocess.check_output(command, encoding='UTF-8')
+    index = GitRefIndex()
+    peeled = {}
+    for line in results.splitlines():
+        (object_id, ref) = line.split('\t', 1)
+        tag = ref[len('refs/tags/'):]
+        if tag.endswith('^{}'):
+            peeled[tag[:-3]] = object_id
+        elif tag not in index.commit_ids:
+            index.add_tag(tag, object_id)
+    # ls-remote lists annotated tags twice: once for the tag object, and once (with a ^{} suffix)
+    # for the commit that it points to.
+    for (tag, commit_id) in peeled.items():
+        index.commit_ids[tag] = commit_id
+    return index
+
+git_ref_indexes = {}
+git_ref_index_lock = threading.Lock()
+git_ref_index_locks = {}
+
+# Returns the (memoized) GitRefIndex for location, which is a local repository directory, or a
+# remote repository URL when remote is True.
+def get_git_ref_index(location, remote = False):
+    key = (location, remote)
+    with git_ref_index_lock:
+        lock = git_ref_index_locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in git_ref_indexes:
+            git_ref_indexes[key] = load_remote_git_ref_index(location) if remote else load_local_git_ref_index(location)
+        return git_ref_indexes[key]
+
+# Must be called after creating tags in dir so that they show up in the next get_git_ref_index.
+def invalidate_git_ref_index(dir):
+    with git_ref_index_lock:
+        git_ref_indexes.pop((dir, False), None)
+
 def get_last_release():
-    result = subprocess.check_output(['git', 'tag'], cwd=sdk_dirs.sdk_ios, encoding='UTF-8')
-    tags = result.splitlines()
-    last_patch = 0
-    if isinstance(tags, list):
-        for tag in tags:
-            match = re.search('^' + mobile_base_version_search_list[-1] + '([0-9]+)$', tag)
-            if match and len(match.groups()) == 1:
-                this_patch = int(match.group(1))
-                if this_patch > last_patch:
-                    last_patch = this_patch
-    if last_patch > 0:
+    last_patch = get_git_ref_index(sdk_dirs.sdk_ios).highest_patch(mobile_base_version)
+    if last_patch is not None:
         return mobile_base_version + str(last_patch)
+    if get_quiet_output(['git', 'rev-parse', '--is-shallow-repository'], sdk_dirs.sdk_ios) == 'true\n':
+        raise Exception(f"Error: No {mobile_base_version} release tags in shallow clone {sdk_dirs.sdk_ios}. Run git fetch --tags there first.")
     return f'{mobile_base_version}0'
 
 def get_next_release(last_release):
@@ -652,99 +2637,415 @@ def get_latest_itwin_version():
 
 latest_versions = {}
 
-def compare_versions(left_list, right_list):
-    for left, right in zip(left_list, right_list):
-        try:
-            # Try to convert both values into integers
-            left_int = int(left)
-            right_int = int(right)
-            if left_int < right_int:
-                return -1
-            elif right_int < left_int:
-                return 1
-        except ValueError:
-            # Integer conversion failed, so just compare the values as strings
-            if left < right:
-                return -1
-            elif right < left:
-                return 1
-    return 0
-    
-def sort_versions(versions):
-    split = []
-    for version in versions:
-        split.append(version.split('.'))
-    split_sorted = sorted(split, key=cmp_to_key(compare_versions))
-    result = []
-    for version in split_sorted:
-        result.append('.'.join(version))
-    return result
+version_regex = re.compile('v?([0-9]+)\\.([0-9]+)\\.([0-9]+)(?:-([0-9A-Za-z.-]+))?(?:\\+[0-9A-Za-z.-]+)?')
+
+# A parsed semver version. Versions are ordered by key, which puts pre-releases before the release
+# they lead up to, compares numeric pre-release identifiers as numbers (and before alphanumeric
+# ones), and ignores build metadata.
+class Version:
+    __slots__ = ('text', 'release', 'prerelease', 'key')
+
+    def __init__(self, text):
+        match = version_regex.fullmatch(text)
+        if not match:
+            raise ValueError("Invalid version: " + text)
+        self.text = text
+        self.release = (int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        self.prerelease = tuple(int(part) if part.isdigit() else part for part in match.group(4).split('.')) if match.group(4) else ()
+        self.key = (
+            self.release,
+            0 if self.prerelease else 1,
+            tuple((0, part, '') if isinstance(part, int) else (1, 0, part) for part in self.prerelease),
+        )
+
+# The versions of a package, sorted once so that all the latest version queries for the package can
+# be answered without going back to the registry.
+class VersionIndex:
+    def __init__(self, versions):
+        parsed = []
+        for text in versions:
+            try:
+                parsed.append(Version(text))
+            except ValueError:
+                pass
+        self.versions = sorted(parsed, key=lambda version: version.key)
+
+    def latest(self, predicate):
+        for version in reversed(self.versions):
+            if predicate(version):
+                return version.text
+        return None
+
+    def latest_matching_prefix(self, prefix):
+        return self.latest(lambda version: version_matches_prefix(version.text, prefix))
+
+version_indexes = {}
+version_indexes_lock = threading.Lock()
+
+def get_version_index(package):
+    with version_indexes_lock:
+        if package in version_indexes:
+            return version_indexes[package]
+    index = VersionIndex(get_registry_client(package).get_versions(package))
+    with version_indexes_lock:
+        return version_indexes.setdefault(package, index)
+
+# Like npm's handling of partial versions (package@4.9), prefix matches every release whose
+# version starts with it, but not pre-releases.
+def version_matches_prefix(version, prefix):
+    if version != prefix and not version.startswith(prefix + '.'):
+        return False
+    return '-' not in version or '-' in prefix
 
 def get_latest_version(package, prefix):
     key = f'{package}@{prefix}'
     if key in latest_versions:
         return latest_versions[key]
-    version_json = subprocess.check_output(['npm', 'view', '--json', key, 'version'])
-    version = json.loads(version_json)
-    if isinstance(version, str):
-        result = version
-    else:
-        # The matching versions are returned in chronological order, so a new release of an older
-        # version might come last.
-        result = sort_versions(version)[-1]
+
+    def lookup():
+        version = get_version_index(package).latest_matching_prefix(prefix)
+        if version is None:
+            raise Exception(f"Error: No versions of {package} match {prefix}")
+        return version
+
+    result = cached_lookup('latest_version', get_registry_client(package).registry_url + key, lookup)
     latest_versions[key] = result
     return result
 
+# Runs each of the given functions on its own thread and returns their results in order. If any of
+# them raises an exception, the first one (in argument order) is re-raised after all have finished.
+def run_concurrently(*funcs):
+    with ThreadPoolExecutor(max_workers=max(1, min(max_lookup_workers, len(funcs)))) as executor:
+        futures = [executor.submit(func) for func in funcs]
+    return [future.result() for future in futures]
+
+# Looks up the latest versions for the given (package, prefix) pairs using a bounded pool of
+# workers. The results end up in latest_versions, where get_latest_version will find them.
+def prefetch_latest_versions(keys):
+    missing = [key for key in dict.fromkeys(keys) if f'{key[0]}@{key[1]}' not in latest_versions]
+    if len(missing) == 1:
+        get_latest_version(*missing[0])
+    elif missing:
+        run_concurrently(*[lambda key=key: get_latest_version(*key) for key in missing])
+
 def get_latest_native_version(itwin_version):
-    deps = subprocess.check_output(['npm', 'show', native_version_package + '@' + itwin_version, 'dependencies'], encoding='UTF-8')
-    match = re.search("'@bentley/imodeljs-native': '([.0-9]+)'", deps)
-    if match and len(match.groups()) == 1:
-        return match.group(1)
-
-def get_first_entry_of_last_line(results):
-    if results:
-        lines = results.splitlines()
-        last = lines[len(lines)-1]
-        entries = last.split()
-        return entries[0]
+    def lookup():
+        deps = get_registry_client(native_version_package).get_dependencies(native_version_package, itwin_version)
+        native_version = deps.get(native_version_dependency)
+        if native_version and re.fullmatch('[.0-9]+', native_version):
+            return native_version
+
+    return cached_lookup('native_version', f'{get_registry_client(native_version_package).registry_url}{native_version_package}@{itwin_version}', lookup)
 
 def get_last_commit_id(dir, tag_filter):
     # Todo: Handle first release with a new prefix
-    results = subprocess.check_output(['git', 'show-ref', '--tags', tag_filter], cwd=dir, encoding='UTF-8')
-    return get_first_entry_of_last_line(results)
+    return get_git_ref_index(dir).commit_id(tag_filter)
 
 def get_last_remote_commit_id(repo, tag_filter):
-    results = subprocess.check_output(['git', 'ls-remote', '--tags', repo, tag_filter], encoding='UTF-8')
-    return get_first_entry_of_last_line(results)
+    def lookup():
+        return get_git_ref_index(repo, True).commit_id(tag_filter)
 
-def get_versions(args, current = False):
-    found_all = False
-    populate_mobile_versions(args, current)
-    print("New release: " + args.new_mobile)
+    return cached_lookup('remote_commit_id', f'{repo}#{tag_filter}', lookup)
 
+def resolve_itwin_versions(args):
     if not hasattr(args, 'new_itwin') or not args.new_itwin:
         args.new_itwin = get_latest_itwin_version()
-    print("iTwin version: " + args.new_itwin)
 
     if not hasattr(args, 'new_add_on') or not args.new_add_on:
         args.new_add_on = get_latest_native_version(args.new_itwin)
 
     if args.new_add_on:
-        found_all = True
-        print("mobile-native-ios version: " + args.new_add_on)
         if not hasattr(args, 'new_add_on_commit_id') or not args.new_add_on_commit_id:
             args.new_add_on_commit_id = get_last_remote_commit_id('https://github.com/iTwin/mobile-native-ios.git', args.new_add_on)
-        print("mobile-native-ios revision: " + args.new_add_on_commit_id)
 
-    if not found_all:
+def get_versions(args, current = False):
+    # The add-on version depends on the iTwin version, and the add-on commit ID depends on the
+    # add-on version, so those lookups happen in order. Everything else is independent, including
+    # the non-core package versions that are needed later by modify_package_json.
+    run_concurrently(
+        lambda: populate_mobile_versions(args, current),
+        lambda: resolve_itwin_versions(args),
+        lambda: prefetch_latest_versions(get_itwin_non_core_version_keys()),
+    )
+    print("New release: " + args.new_mobile)
+    print("iTwin version: " + args.new_itwin)
+
+    if not args.new_add_on:
         raise Exception("Error: Unable to determine all versions.")
+    print("mobile-native-ios version: " + args.new_add_on)
+    print("mobile-native-ios revision: " + args.new_add_on_commit_id)
+
+# Runs command in dir, keeping only the last max_lines lines of output (or, when stream_prefix is
+# set, printing each line with that prefix as it arrives). Returns (exit code, output lines,
+# number of dropped lines, seconds).
+def run_captured(command, dir, max_lines, stream_prefix = None):
+    start = time.perf_counter()
+    output = collections.deque(maxlen=max_lines)
+    num_lines = 0
+    with trace_subprocess(command, dir) as span:
+        try:
+            with subprocess.Popen(command, cwd=dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace') as process:
+                for line in process.stdout:
+                    if stream_prefix is None:
+                        output.append(line)
+                        num_lines += 1
+                    else:
+                        with output_lock:
+                            sys.stdout.write(f'[{stream_prefix}] {line}')
+                            sys.stdout.flush()
+            exit_code = process.returncode
+        except OSError as error:
+            # The command could not be started (for example, it doesn't exist).
+            output.append(f'{error}\n')
+            num_lines += 1
+            exit_code = 127
+        span['exit_code'] = exit_code
+    return (exit_code, output, max(0, num_lines - len(output)), time.perf_counter() - start)
+
+def do_command_parallel(args, command):
+    dirs = list(sdk_dirs)
+    results = {}
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for dir in dirs:
+            stream_prefix = os.path.basename(dir) if args.stream else None
+            futures[executor.submit(run_captured, command, dir, args.max_lines, stream_prefix)] = dir
+        for future in as_completed(futures):
+            dir = futures[future]
+            results[dir] = future.result()
+            if not args.stream:
+                (exit_code, output, num_dropped, _) = results[dir]
+                with output_lock:
+                    sys.stdout.write(f'===== {dir} (exit code {exit_code}) =====\n')
+                    if num_dropped:
+                        sys.stdout.write(f'... {num_dropped} earlier lines not shown ...\n')
+                    sys.stdout.write(''.join(output))
+                    sys.stdout.flush()
+    name_width = max(len(os.path.basename(dir)) for dir in dirs)
+    print("-------------------------------------------------------------------------------")
+    for dir in dirs:
+        (exit_code, _, _, seconds) = results[dir]
+        print(f'{os.path.basename(dir):<{name_width}}  exit code: {exit_code:<3}  time: {seconds:.1f}s')
 
 def do_command(args):
     if args.strings:
         all_args = ' '.join(args.strings)
-        args = all_args.split()
+        command = all_args.split()
+        if args.jobs > 1:
+            do_command_parallel(args, command)
+            return
         for dir in sdk_dirs:
-            subprocess.call(args, cwd=dir)
+            if args.print:
+                print("Running in dir: " + dir)
+            with trace_subprocess(command, dir) as span:
+                span['exit_code'] = subprocess.call(command, cwd=dir)
+
+# The original, uncompiled replace_all inner loop. Only used as the baseline for benchmark_command.
+def apply_replacements_uncompiled(line, replacements):
+    num_found = 0
+    for tuple in replacements:
+        (search_exp, replace_exp, is_itwin) = parse_replacement_tuple(tuple)
+        if re.search(search_exp, line) and not is_itwin_non_core_project_line(line, is_itwin):
+            num_found += 1
+            line = re.sub(search_exp, replace_exp, line)
+    return (line, num_found)
+
+def populate_benchmark_versions(args):
+    args.new_mobile = f'{mobile_base_version}99'
+    args.current_mobile = f'{mobile_base_version}98'
+    args.new_itwin = f'{itwin_version_prefix}.99'
+    args.new_add_on = f'{itwin_version_prefix}.98'
+    for (packages, prefix, _) in get_itwin_non_core_groups():
+        latest_versions[f'@itwin/{packages[0]}@{prefix}'] = f'{prefix}.99.0'
+
+# Generates a package.json with num_dependencies entries, mixing iTwin core packages, iTwin
+# non-core packages, and third party packages.
+def generate_benchmark_package_json(num_dependencies):
+    itwin_versions = [search.replace('\\', '') + '0' for search in itwin_base_version_search_list]
+    lines = ['{\n', f'  "name": "{itwin_scope}/benchmark",\n', f'  "version": "{mobile_base_version}0",\n', '  "dependencies": {\n']
+    for i in range(num_dependencies):
+        kind = i % 4
+        if kind == 0:
+            lines.append(f'    "{itwin_scope}/core-package-{i}": "{itwin_versions[i % len(itwin_versions)]}",\n')
+        elif kind == 1:
+            package = itwin_non_core_packages[i % len(itwin_non_core_packages)]
+            lines.append(f'    "{itwin_scope}/{package}": "{itwin_versions[i % len(itwin_versions)]}",\n')
+        else:
+            lines.append(f'    "third-party-package-{i}": "^{i % 10}.{i % 7}.{i % 3}",\n')
+    lines.append(f'    "{itwin_scope}/mobile-sdk-core": "{mobile_base_version}0"\n')
+    lines.append('  }\n')
+    lines.append('}\n')
+    return lines
+
+def time_call(repeat, func):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+def benchmark_command(args):
+    if args.suite:
+        benchmark_suite(args)
+        return
+    populate_benchmark_versions(args)
+    tuples = get_package_json_tuples(args)
+    lines = generate_benchmark_package_json(args.dependencies)
+    print(f'Benchmarking {len(tuples)} package.json replacement rules against {len(lines)} lines (best of {args.repeat}).')
+
+    def run_uncompiled():
+        return [apply_replacements_uncompiled(line, tuples) for line in lines]
+
+    def run_compiled():
+        rules = ReplacementRules(tuples)
+        return [rules.apply(line) for line in lines]
+
+    (uncompiled_time, uncompiled_result) = time_call(args.repeat, run_uncompiled)
+    (compiled_time, compiled_result) = time_call(args.repeat, run_compiled)
+    if uncompiled_result != compiled_result:
+        raise Exception("Error: Compiled replacement results differ from uncompiled results")
+    num_found = sum(found for (_, found) in compiled_result)
+    print(f'Replacements: {num_found}')
+    print(f'Uncompiled: {uncompiled_time * 1000:.1f} ms')
+    print(f'Compiled:   {compiled_time * 1000:.1f} ms (includes compiling the rules)')
+    print(f'Speedup:    {uncompiled_time / compiled_time:.1f}x')
+
+    content = ''.join(lines)
+    versions = get_package_json_versions(args)
+    (structured_time, (_, structured_found)) = time_call(args.repeat, lambda: update_package_json_content(content, args.new_mobile, args.new_itwin, versions))
+    print(f'Structured: {structured_time * 1000:.1f} ms ({structured_found} values updated)')
+    print(f'Speedup:    {uncompiled_time / structured_time:.1f}x')
+
+def write_benchmark_file(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', encoding='UTF-8') as file:
+        file.write(content)
+
+# Generates a project.pbxproj with num_objects file references, along with the Swift package
+# references that modify_project_pbxproj looks for.
+def generate_benchmark_pbxproj(num_objects):
+    lines = ['// !$*UTF8*$!\n', '{\n', '\tobjects = {\n', '/* Begin PBXFileReference section */\n']
+    for i in range(num_objects):
+        lines.append(f'\t\t{i:024X} /* File{i}.swift */ = {{isa = PBXFileReference; lastKnownFileType = sourcecode.swift; path = File{i}.swift; sourceTree = "<group>"; }};\n')
+    lines.append('/* End PBXFileReference section */\n')
+    lines.append('/* Begin XCRemoteSwiftPackageReference section */\n')
+    for (name, url, version) in [('mobile-sdk-ios', 'https://github.com/iTwin/mobile-sdk-ios.git', f'{mobile_base_version}0'), ('other', 'https://github.com/other/other.git', '1.0.0')]:
+        lines.append(f'\t\t{name.upper()} /* XCRemoteSwiftPackageReference "{name}" */ = {{\n')
+        lines.append('\t\t\tisa = XCRemoteSwiftPackageReference;\n')
+        lines.append(f'\t\t\trepositoryURL = "{url}";\n')
+        lines.append(f'\t\t\trequirement = {{\n\t\t\t\tkind = exactVersion;\n\t\t\t\tversion = {version};\n\t\t\t}};\n')
+        lines.append('\t\t};\n')
+    lines.append('/* End XCRemoteSwiftPackageReference section */\n')
+    lines.append('\t};\n}\n')
+    return ''.join(lines)
+
+# Generates a Package.resolved in the given format version with num_pins third party pins, along
+# with the itwin-mobile-native and itwin-mobile-sdk pins.
+def generate_benchmark_package_resolved(num_pins, format_version):
+    pins = [(f'package-{i}', f'https://github.com/example/package-{i}.git', f'{i % 10}.{i % 7}.{i % 3}') for i in range(num_pins)]
+    pins.append(('mobile-native-ios', 'https://github.com/iTwin/mobile-native-ios', f'{itwin_version_prefix}.0'))
+    pins.append(('mobile-sdk-ios', 'https://github.com/iTwin/mobile-sdk-ios.git', f'{mobile_base_version}0'))
+    if format_version == 1:
+        pins = [{'package': name, 'repositoryURL': url, 'state': {'branch': None, 'revision': '0' * 40, 'version': version}} for (name, url, version) in pins]
+        return json.dumps({'object': {'pins': pins}, 'version': 1}, indent=2) + '\n'
+    pins = [{'identity': name, 'kind': 'remoteSourceControl', 'location': url, 'state': {'revision': '0' * 40, 'version': version}} for (name, url, version) in pins]
+    return json.dumps({'pins': pins, 'version': 2}, indent=2, separators=(',', ' : ')) + '\n'
+
+# Generates synthetic copies of the five repositories under parent_dir, containing every file that
+# the modify_* functions update. The sample app globals must already be set to the names to use.
+def generate_benchmark_fixture(args):
+    old_mobile = f'{mobile_base_version}0'
+    old_itwin = f'{itwin_version_prefix}.0'
+    for dir in sdk_dirs:
+        os.makedirs(dir, exist_ok=True)
+    readme_lines = [f'Filler line {i} of the README, which mentions iTwin.js and version numbers like 1.2.3.\n' for i in range(args.dependencies)]
+    write_benchmark_file(os.path.join(sdk_dirs.sdk_ios, 'README.md'), ''.join(readme_lines + [
+        f'Set the "Dependency Rule" to "Exact Version" and the version to "{old_mobile}".\n',
+        f'    .package(name: "itwin-mobile-sdk", url: "https://github.com/iTwin/mobile-sdk-ios", .exact("{old_mobile}"))\n',
+        f"  pod 'itwin-mobile-native', podspec: 'https://github.com/iTwin/mobile-native-ios/releases/download/{old_itwin}/itwin-mobile-native-ios.podspec'\n",
+        f"  pod 'itwin-mobile-sdk', podspec: 'https://github.com/iTwin/mobile-sdk-ios/releases/download/{old_mobile}/itwin-mobile-sdk.podspec'\n",
+        f'- Make sure to set the `itwin-mobile-native` CocoaPod to version {old_itwin}\n',
+        f'- These packages use __iTwin.js {old_itwin}__.\n',
+    ]))
+    write_benchmark_file(os.path.join(sdk_dirs.sdk_ios, 'Package.swift'), f'        .package(name: "itwin-mobile-native", url: "https://github.com/iTwin/mobile-native-ios", .exact("{old_itwin}")),\n')
+    write_benchmark_file(os.path.join(sdk_dirs.sdk_ios, 'itwin-mobile-sdk.podspec'), f'  spec.version      = "{old_mobile}"\n  spec.dependency "itwin-mobile-native", "{old_itwin}"\n')
+    write_benchmark_file(os.path.join(sdk_dirs.sdk_ios, 'Package.resolved'), generate_benchmark_package_resolved(args.pins, 1))
+    write_benchmark_file(os.path.join(sdk_dirs.sdk_android, 'README.md'), ''.join(readme_lines + [f'- These packages use __iTwin.js {old_itwin}__.\n']))
+    write_benchmark_file(os.path.join(sdk_dirs.sdk_android, 'mobile-sdk', 'build.gradle'), f"versionName '{old_mobile}'\nversion = '{old_mobile}'\nversion = '{old_mobile}-debug'\napi 'com.github.itwin:mobile-native-android:{old_itwin}'\n")
+    package_json = ''.join(generate_benchmark_package_json(args.dependencies))
+    for dir in [sdk_dirs.sdk_core, sdk_dirs.ui_react, os.path.join(sdk_dirs.samples, react_app_subdir), os.path.join(sdk_dirs.samples, token_server_subdir)]:
+        write_benchmark_file(os.path.join(dir, 'package.json'), package_json)
+    pbxproj = generate_benchmark_pbxproj(args.pbxproj_objects)
+    package_resolved = generate_benchmark_package_resolved(args.pins, 2)
+    for dir in get_xcodeproj_dirs():
+        write_benchmark_file(os.path.join(dir, 'project.pbxproj'), pbxproj)
+        write_benchmark_file(os.path.join(dir, 'project.xcworkspace/xcshareddata/swiftpm/Package.resolved'), package_resolved)
+    build_gradle = f"dependencies {{\n    implementation 'com.github.itwin.mobilesdk:mobile-sdk-android:{old_mobile}'\n}}\n"
+    for (filename, _, _) in get_samples_build_gradle_rewrites(args):
+        write_benchmark_file(filename, build_gradle)
+    write_benchmark_file(os.path.join(sdk_dirs.samples, 'Android/Shared/build.gradle'), build_gradle)
+
+# Returns (name, function, filenames) for each of the rewrite functions measured by benchmark_suite.
+# Each function takes one of the filenames.
+def get_benchmark_suite_cases(args):
+    package_json_tuples = get_package_json_tuples(args)
+    package_json_dirs = [sdk_dirs.sdk_core, sdk_dirs.ui_react, os.path.join(sdk_dirs.samples, react_app_subdir), os.path.join(sdk_dirs.samples, token_server_subdir)]
+    xcodeproj_dirs = get_xcodeproj_dirs()
+    return [
+        ('replace_all', lambda filename: replace_all(filename, package_json_tuples), [os.path.join(sdk_dirs.sdk_core, 'package.json')]),
+        ('modify_package_json', lambda filename: modify_package_json(args, os.path.dirname(filename)), [os.path.join(dir, 'package.json') for dir in package_json_dirs]),
+        ('modify_project_pbxproj', lambda filename: modify_project_pbxproj(args, filename), [os.path.join(dir, 'project.pbxproj') for dir in xcodeproj_dirs]),
+        ('modify_package_resolved', lambda filename: modify_package_resolved(args, filename), [os.path.join(sdk_dirs.sdk_ios, 'Package.resolved')] + [os.path.join(dir, 'project.xcworkspace/xcshareddata/swiftpm/Package.resolved') for dir in xcodeproj_dirs]),
+        ('modify_readme_md', lambda filename: modify_readme_md(args, os.path.dirname(filename)), [os.path.join(dir, 'README.md') for dir in [sdk_dirs.sdk_ios, sdk_dirs.sdk_android]]),
+        ('modify_package_swift', lambda filename: modify_package_swift(args, filename), [os.path.join(sdk_dirs.sdk_ios, 'Package.swift')]),
+        ('modify_podspec', lambda filename: modify_podspec(args, filename), [os.path.join(sdk_dirs.sdk_ios, 'itwin-mobile-sdk.podspec')]),
+        ('modify_build_gradle', lambda filename: modify_build_gradle(args, filename), [os.path.join(sdk_dirs.sdk_android, 'mobile-sdk', 'build.gradle')]),
+        ('modify_sample_build_gradle', lambda filename: modify_sample_build_gradle(args, filename), [filename for (filename, _, _) in get_samples_build_gradle_rewrites(args)] + [os.path.join(sdk_dirs.samples, 'Android/Shared/build.gradle')]),
+    ]
+
+# Runs each rewrite function against synthetic repositories generated in a temporary directory, and
+# reports its throughput and peak memory use. Files are rewritten in dry run transactions, so the
+# fixture can be reused for every repetition, and no npm or git commands are run.
+def benchmark_suite(args):
+    import tracemalloc
+    global sdk_dirs, ios_sample_names, android_sample_names, react_native_sample_names
+    saved_globals = (sdk_dirs, ios_sample_names, android_sample_names, react_native_sample_names)
+    parent_dir = tempfile.mkdtemp(prefix='newVersion-benchmark-')
+    try:
+        sdk_dirs = MobileSdkDirs(argparse.Namespace(parent_dir=parent_dir))
+        ios_sample_names = [f'BenchmarkSample{i}' for i in range(args.samples)]
+        android_sample_names = ios_sample_names
+        react_native_sample_names = ios_sample_names
+        populate_benchmark_versions(args)
+        args.new_commit_id = '1' * 40
+        args.new_add_on_commit_id = '2' * 40
+        generate_benchmark_fixture(args)
+        print(f'Benchmarking rewrites in {parent_dir} with {args.dependencies} dependencies, {args.samples} samples per platform, {args.pbxproj_objects} pbxproj objects, and {args.pins} pins (best of {args.repeat}).')
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            cases = get_benchmark_suite_cases(args)
+        print(f'{"Function":<28}{"Files":>6}{"Size":>11}{"Time":>12}{"Throughput":>14}{"Peak memory":>14}')
+        for (name, function, filenames) in cases:
+            def run():
+                with rewrite_transaction(True):
+                    for filename in filenames:
+                        function(filename)
+            size = sum(os.path.getsize(filename) for filename in filenames)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                (seconds, _) = time_call(args.repeat, run)
+                tracemalloc.start()
+                try:
+                    run()
+                    (_, peak) = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+            megabytes = size / (1024 * 1024)
+            print(f'{name:<28}{len(filenames):>6}{megabytes:>8.2f} MB{seconds * 1000:>9.1f} ms{megabytes / seconds:>9.1f} MB/s{peak / (1024 * 1024):>11.2f} MB')
+    finally:
+        (sdk_dirs, ios_sample_names, android_sample_names, react_native_sample_names) = saved_globals
+        shutil.rmtree(parent_dir, ignore_errors=True)
 
 def add_force_argument(parser):
     parser.add_argument('-f', '--force', action='store_true', default=False, help='Force even if local changes already exist')
@@ -762,20 +3063,29 @@ def add_common_stage_arguments(parser, new_mobile=True):
         add_new_mobile_argument(parser)
     parser.add_argument('-t', '--title', dest='title', help='Release title')
     parser.add_argument('--notes', dest='notes', help='Release notes')
+    parser.add_argument('--restart', action='store_true', default=False, help='Ignore the journal of an earlier failed run of this stage and start over')
 
 # We always want to publish our packages using Node 16 (>= 16.11), so check for that.
 # This insures that our package-lock.json files are conistent for npm.
 def check_node_version():
     print("Verifying that node version is 18.x, with minimum of 18.16.")
-    results = subprocess.check_output(['node', '--version'], encoding='UTF-8')
+    results = get_tool_version('node')
     match = re.search('^v18\\.([0-9]+)\\.', results)
     if not match or int(match.group(1)) < 16:
-        raise Exception("Error: Node 18.x required, with minimum of 18.16. You have " + results.rstrip('\n') + ".")
+        raise Exception("Error: Node 18.x required, with minimum of 18.16. You have " + results + ".")
     if len(match.groups()) != 1:
-        raise Exception("Error parsing Node version string: " + results.rstrip('\n') + ".")
+        raise Exception("Error parsing Node version string: " + results + ".")
 
 if __name__ == '__main__':
+    global_parser = argparse.ArgumentParser(add_help=False)
+    global_parser.add_argument('-d', '--parentDir', dest='parent_dir', help='The parent directory of the iTwin Mobile SDK GitHub repositories')
+    global_parser.add_argument('--refresh', action='store_true', default=False, help='Ignore (and replace) cached npm registry and git remote lookups')
+    global_parser.add_argument('--noCache', dest='no_cache', action='store_true', default=False, help='Do not read or write the on-disk lookup cache')
+    global_parser.add_argument('--forceInstall', dest='force_install', action='store_true', default=False, help='Run npm install even when package.json, package-lock.json, and the node and npm versions are unchanged since the last install')
+    global_parser.add_argument('--trace', dest='trace', help='Write a Chrome trace event JSON file with the timing of every subprocess, registry lookup, and file rewrite')
+    global_parser.add_argument('--registry', dest='registry', help='The npm registry to query for package versions (default: the registry in the npm configuration)')
     parser = argparse.ArgumentParser(
+        parents=[global_parser],
         description='Script for helping with creating a new Mobile SDK version.',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog=textwrap.dedent('''\
@@ -786,84 +3096,180 @@ if __name__ == '__main__':
             3. newVersion.py stage2
             4. Wait for @itwin/mobile-ui-react to be npm published
             5. newVersion.py stage3
+
+            Steps 2 and 3 can be replaced by newVersion.py watch stage2, and steps 4 and 5 by
+            newVersion.py watch stage3.
             '''))
-    parser.add_argument('-d', '--parentDir', dest='parent_dir', help='The parent directory of the iTwin Mobile SDK GitHub repositories')
     sub_parsers = parser.add_subparsers(title='Commands', metavar='')
-
-    parser_change = sub_parsers.add_parser('change', help='Change version (alternative to bump, specify versions)')
-    parser_change.set_defaults(func=change_command)
-    add_common_change_arguments(parser_change)
-    add_force_argument(parser_change)
-
-    parser_bump = sub_parsers.add_parser('bump', help='Create new point release')
-    parser_bump.set_defaults(func=bump_command)
-    add_new_mobile_argument(parser_bump)
-    add_force_argument(parser_bump)
-
-    parser_changeitwin = sub_parsers.add_parser('changeitwin', help='Change iTwin version (alternative to bumpitwin, specify versions)')
-    parser_changeitwin.set_defaults(func=changeitwin_command)
-    add_common_change_arguments(parser_changeitwin)
-    add_force_argument(parser_changeitwin)
-
-    parser_bumpitwin = sub_parsers.add_parser('bumpitwin', help='Update all locally for new iTwin version')
-    parser_bumpitwin.set_defaults(func=bumpitwin_command)
-    add_common_change_arguments(parser_bumpitwin, False)
-    add_force_argument(parser_bumpitwin)
-
-    parser_changeui = sub_parsers.add_parser('changeui', help='Change version for mobile-ui-react (alternative to bumpui, specify versions)')
-    parser_changeui.set_defaults(func=changeui_command)
-    add_common_change_arguments(parser_changeui)
-
-    parser_bumpui = sub_parsers.add_parser('bumpui', help='Update mobile-ui-react to reflect published mobile-core')
-    parser_bumpui.set_defaults(func=bumpui_command)
-    add_new_mobile_argument(parser_bumpui)
-
-    parser_changesamples = sub_parsers.add_parser('changesamples', help='Alternative to bumpsamples: must specify versions')
-    parser_changesamples.set_defaults(func=changesamples_command)
-    add_common_change_arguments(parser_changesamples)
-
-    parser_bumpsamples = sub_parsers.add_parser('bumpsamples', help='Update mobile-samples to reflect published mobile-core')
-    parser_bumpsamples.set_defaults(func=bumpsamples_command)
-    add_new_mobile_argument(parser_bumpsamples)
-
-    parser_stage1 = sub_parsers.add_parser('stage1', help='Execute bump then release1')
-    parser_stage1.set_defaults(func=stage1_command)
-    add_common_stage_arguments(parser_stage1)
-    add_force_argument(parser_stage1)
-
-    parser_stage2 = sub_parsers.add_parser('stage2', help='Execute bumpui then release2')
-    parser_stage2.set_defaults(func=stage2_command)
-    add_common_stage_arguments(parser_stage2)
-
-    parser_stage3 = sub_parsers.add_parser('stage3', help='Execute bumpsamples then release3')
-    parser_stage3.set_defaults(func=stage3_command)
-    add_common_stage_arguments(parser_stage3, False)
-
-    parser_do = sub_parsers.add_parser('do', help='Run a command in each dir')
-    parser_do.set_defaults(func=do_command)
-    parser_do.add_argument('-p', '--print', action='store_true', default=False, help='Print each dir')
-    parser_do.add_argument('strings', metavar='arg', nargs='+')
-
-    parser_test = sub_parsers.add_parser('test', help='Local test of new iTwin release.')
-    parser_test.set_defaults(func=test_command)
-    add_common_change_arguments(parser_test, False)
-    add_force_argument(parser_test)
-
-    parser_checkversions = sub_parsers.add_parser('checkversions', help='Check versions for next release.')
-    parser_checkversions.set_defaults(func=checkversions_command)
-
-    parser_changesamplestest = sub_parsers.add_parser('changesamplestest', help='Test command')
-    parser_changesamplestest.set_defaults(func=changesamplestest_command)
+    commands = []
+
+    def add_command(name, help, add_arguments):
+        commands.append((name, help, add_arguments))
+
+    def add_change_arguments(parser_change):
+        parser_change.set_defaults(func=change_command)
+        add_common_change_arguments(parser_change)
+        add_force_argument(parser_change)
+    add_command('change', 'Change version (alternative to bump, specify versions)', add_change_arguments)
+
+    def add_bump_arguments(parser_bump):
+        parser_bump.set_defaults(func=bump_command)
+        add_new_mobile_argument(parser_bump)
+        add_force_argument(parser_bump)
+    add_command('bump', 'Create new point release', add_bump_arguments)
+
+    def add_changeitwin_arguments(parser_changeitwin):
+        parser_changeitwin.set_defaults(func=changeitwin_command)
+        add_common_change_arguments(parser_changeitwin)
+        add_force_argument(parser_changeitwin)
+    add_command('changeitwin', 'Change iTwin version (alternative to bumpitwin, specify versions)', add_changeitwin_arguments)
+
+    def add_bumpitwin_arguments(parser_bumpitwin):
+        parser_bumpitwin.set_defaults(func=bumpitwin_command)
+        add_common_change_arguments(parser_bumpitwin, False)
+        add_force_argument(parser_bumpitwin)
+    add_command('bumpitwin', 'Update all locally for new iTwin version', add_bumpitwin_arguments)
+
+    def add_changeui_arguments(parser_changeui):
+        parser_changeui.set_defaults(func=changeui_command)
+        add_common_change_arguments(parser_changeui)
+    add_command('changeui', 'Change version for mobile-ui-react (alternative to bumpui, specify versions)', add_changeui_arguments)
+
+    def add_bumpui_arguments(parser_bumpui):
+        parser_bumpui.set_defaults(func=bumpui_command)
+        add_new_mobile_argument(parser_bumpui)
+    add_command('bumpui', 'Update mobile-ui-react to reflect published mobile-core', add_bumpui_arguments)
+
+    def add_changesamples_arguments(parser_changesamples):
+        parser_changesamples.set_defaults(func=changesamples_command)
+        add_common_change_arguments(parser_changesamples)
+    add_command('changesamples', 'Alternative to bumpsamples: must specify versions', add_changesamples_arguments)
+
+    def add_bumpsamples_arguments(parser_bumpsamples):
+        parser_bumpsamples.set_defaults(func=bumpsamples_command)
+        add_new_mobile_argument(parser_bumpsamples)
+    add_command('bumpsamples', 'Update mobile-samples to reflect published mobile-core', add_bumpsamples_arguments)
+
+    def add_stage1_arguments(parser_stage1):
+        parser_stage1.set_defaults(func=stage1_command)
+        add_common_stage_arguments(parser_stage1)
+        add_force_argument(parser_stage1)
+    add_command('stage1', 'Execute bump then release1', add_stage1_arguments)
+
+    def add_stage2_arguments(parser_stage2):
+        parser_stage2.set_defaults(func=stage2_command)
+        add_common_stage_arguments(parser_stage2)
+    add_command('stage2', 'Execute bumpui then release2', add_stage2_arguments)
+
+    def add_stage3_arguments(parser_stage3):
+        parser_stage3.set_defaults(func=stage3_command)
+        add_common_stage_arguments(parser_stage3, False)
+    add_command('stage3', 'Execute bumpsamples then release3', add_stage3_arguments)
+
+    def add_watch_arguments(parser_watch):
+        parser_watch.set_defaults(func=watch_command)
+        parser_watch.add_argument('stage', choices=list(watch_stage_packages), help='The stage to run once the packages are published')
+        add_common_stage_arguments(parser_watch)
+        parser_watch.add_argument('--deadline', type=float, default=watch_deadline_minutes, help='Give up if the packages have not been published after this many minutes')
+        parser_watch.add_argument('--interval', type=float, default=watch_poll_interval, help='Seconds to wait before polling the registry again the first time (doubling after each poll)')
+        parser_watch.add_argument('--maxInterval', dest='max_interval', type=float, default=watch_max_poll_interval, help='The most seconds to wait between polls')
+    add_command('watch', 'Wait for the packages that stage2 or stage3 depends on to be npm published, then run that stage', add_watch_arguments)
+
+    def add_do_arguments(parser_do):
+        parser_do.set_defaults(func=do_command, skip_node_check=True)
+        parser_do.add_argument('-p', '--print', action='store_true', default=False, help='Print each dir')
+        parser_do.add_argument('-j', '--jobs', type=int, default=1, help='Number of dirs to run the command in at the same time')
+        parser_do.add_argument('--stream', action='store_true', default=False, help='With --jobs, print output as it arrives, prefixed with the dir name, instead of grouped by dir')
+        parser_do.add_argument('--maxLines', dest='max_lines', type=int, default=do_max_output_lines, help='With --jobs, the number of output lines to keep for each dir')
+        parser_do.add_argument('strings', metavar='arg', nargs='+')
+    add_command('do', 'Run a command in each dir', add_do_arguments)
+
+    def add_link_arguments(parser_link):
+        parser_link.set_defaults(func=link_command, skip_node_check=True)
+        link_group = parser_link.add_mutually_exclusive_group()
+        link_group.add_argument('--verify', action='store_true', default=False, help='Check that the linked files are up to date instead of linking')
+        link_group.add_argument('--undo', action='store_true', default=False, help='Remove the linked packages instead of linking')
+        parser_link.add_argument('dirs', metavar='dir', nargs='*', help='The dirs to link (default: the JS dirs that have relativeDependencies)')
+    add_command('link', 'Link the relativeDependencies of the JS dirs into their node_modules.', add_link_arguments)
+
+    def add_test_arguments(parser_test):
+        parser_test.set_defaults(func=test_command)
+        add_common_change_arguments(parser_test, False)
+        add_force_argument(parser_test)
+    add_command('test', 'Local test of new iTwin release.', add_test_arguments)
+
+    def add_matrix_arguments(parser_matrix):
+        parser_matrix.set_defaults(func=matrix_command)
+        parser_matrix.add_argument('versions', metavar='version', nargs='*', help='ITWIN[:ADD_ON] versions to test, where ITWIN can be a prefix such as 4.8 (default: the prefixes in itwin_base_version_search_list)')
+        parser_matrix.add_argument('-j', '--jobs', type=int, help='Number of versions to test at the same time (default: based on the number of CPUs)')
+        parser_matrix.add_argument('--worktrees', help='The directory for the worktree sets (default: .newVersion-matrix in the parent directory)')
+    add_command('matrix', 'Test several iTwin versions at the same time, each in its own set of git worktrees.', add_matrix_arguments)
+
+    def add_bootstrap_arguments(parser_bootstrap):
+        parser_bootstrap.set_defaults(func=bootstrap_command, skip_node_check=True)
+        parser_bootstrap.add_argument('--baseUrl', dest='base_url', default=git_base_url, help='The URL (or local directory) containing the <repository>.git repositories to clone')
+        parser_bootstrap.add_argument('--depth', type=int, help='Make shallow clones with this many commits, instead of partial clones')
+        parser_bootstrap.add_argument('--reference', help='A directory of local mirrors (<repository> or <repository>.git) to share objects with')
+    add_command('bootstrap', 'Clone (or update) all the repositories at the same time.', add_bootstrap_arguments)
+
+    def add_checkversions_arguments(parser_checkversions):
+        parser_checkversions.set_defaults(func=checkversions_command)
+    add_command('checkversions', 'Check versions for next release.', add_checkversions_arguments)
+
+    def add_changesamplestest_arguments(parser_changesamplestest):
+        parser_changesamplestest.set_defaults(func=changesamplestest_command)
+    add_command('changesamplestest', 'Test command', add_changesamplestest_arguments)
+
+    def add_plan_arguments(parser_plan):
+        parser_plan.set_defaults(func=plan_command, skip_node_check=True)
+        add_common_change_arguments(parser_plan, False)
+        add_force_argument(parser_plan)
+        parser_plan.add_argument('-o', '--output', default='newVersion-plan.json', help='The plan file to write')
+        parser_plan.add_argument('--scope', choices=['sdk', 'ui', 'samples', 'all'], default='all', help='Which repositories to plan changes for')
+        parser_plan.add_argument('--current', action='store_true', default=False, help='Keep the current iTwin Mobile SDK version (like bumpitwin) instead of bumping it')
+    add_command('plan', 'Resolve versions and compute all file changes, writing them to a plan file for apply', add_plan_arguments)
+
+    def add_apply_arguments(parser_apply):
+        parser_apply.set_defaults(func=apply_command, skip_node_check=True)
+        parser_apply.add_argument('plan', help='The plan file written by the plan command')
+    add_command('apply', 'Apply the file changes in a plan file without resolving any versions', add_apply_arguments)
+
+    def add_benchmark_arguments(parser_benchmark):
+        parser_benchmark.set_defaults(func=benchmark_command, skip_node_check=True)
+        parser_benchmark.add_argument('--dependencies', type=int, default=5000, help='Number of dependencies in the generated package.json')
+        parser_benchmark.add_argument('--repeat', type=int, default=3, help='Number of times to repeat each measurement')
+        parser_benchmark.add_argument('--suite', action='store_true', default=False, help='Benchmark every rewrite function against synthetic repositories in a temporary directory')
+        parser_benchmark.add_argument('--samples', type=int, default=10, help='Number of sample apps per platform in the --suite repositories')
+        parser_benchmark.add_argument('--pbxprojObjects', dest='pbxproj_objects', type=int, default=5000, help='Number of objects in each --suite project.pbxproj')
+        parser_benchmark.add_argument('--pins', type=int, default=200, help='Number of pins in each --suite Package.resolved')
+    add_command('benchmark', 'Benchmark the package.json replacement rules, or (with --suite) all the rewrite functions.', add_benchmark_arguments)
+
+    # Only the parser of the command being run is built, unless the top-level help is needed.
+    (_, command_args) = global_parser.parse_known_args()
+    command_name = next((arg for arg in command_args if not arg.startswith('-')), None)
+    build_all = command_args[:1] in (['-h'], ['--help']) or command_name not in [name for (name, _, _) in commands]
+    for (name, help, add_arguments) in commands:
+        if build_all or name == command_name:
+            add_arguments(sub_parsers.add_parser(name, help=help))
 
     args = parser.parse_args()
 
     process_environment(args)
     sdk_dirs = MobileSdkDirs(args)
-
+    if not args.no_cache:
+        lookup_cache = LookupCache(get_lookup_cache_filename(), args.refresh)
+    npm_config = read_npm_config()
+    registry_client = RegistryClient(args.registry or npm_config.get('registry') or npm_registry)
+
+    force_npm_install = args.force_install
+    if args.trace:
+        tracer = Tracer()
     try:
         if hasattr(args, 'func'):
-            check_node_version()
-            args.func(args)
+            if not getattr(args, 'skip_node_check', False):
+                check_node_version()
+            with trace_span(' '.join(sys.argv[1:]), 'command'):
+                args.func(args)
         else:
             parser.print_help()
     except Exception as error:
@@ -871,3 +3277,8 @@ if __name__ == '__main__':
         # traceback.print_exc()
         print(error)
         exit(1)
+    finally:
+        if tracer is not None:
+            tracer.print_summary(trace_summary_count)
+            tracer.save(os.path.realpath(args.trace))
+            print("Wrote trace to: " + os.path.realpath(args.trace))
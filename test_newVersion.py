@@ -0,0 +1,661 @@
+import argparse
+import gzip
+import http.server
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import newVersion
+
+package_json_fixture = '''{
+  "name": "react-app",
+  "version": "0.22.1",
+  "private": true,
+  "dependencies": {
+    "@itwin/appui-react": "4.4.0",
+    "@itwin/components-react": "4.4.0",
+    "@itwin/core-frontend": "4.1.3",
+    "@itwin/core-common": "4.1.3",
+    "@itwin/imodels-access-frontend": "4.0.1",
+    "@itwin/mobile-sdk-core": "0.22.1",
+    "@itwin/mobile-ui-react": "0.22.1",
+    "@itwin/presentation-components": "4.2.0",
+    "react": "^17.0.2"
+  },
+  "devDependencies": {
+    "@itwin/build-tools": "4.1.3",
+    "@itwin/eslint-plugin": "4.0.0-dev.48",
+    "typescript": "~5.0.2"
+  }
+}
+'''
+
+package_resolved_v1_fixture = '''{
+  "object": {
+    "pins": [
+      {
+        "package": "itwin-mobile-native",
+        "repositoryURL": "https://github.com/iTwin/mobile-native-ios",
+        "state": {
+          "branch": null,
+          "revision": "0123456789abcdef0123456789abcdef01234567",
+          "version": "4.1.1"
+        }
+      },
+      {
+        "package": "itwin-mobile-sdk",
+        "repositoryURL": "https://github.com/iTwin/mobile-sdk-ios",
+        "state": {
+          "branch": null,
+          "revision": "89abcdef0123456789abcdef0123456789abcdef",
+          "version": "0.22.1"
+        }
+      },
+      {
+        "package": "PromiseKit",
+        "repositoryURL": "https://github.com/mxcl/PromiseKit",
+        "state": {
+          "branch": null,
+          "revision": "8a98e31a03854f8665d12ca2f3f1e6de6dc96a5b",
+          "version": "6.18.1"
+        }
+      }
+    ]
+  },
+  "version": 1
+}
+'''
+
+package_resolved_v2_fixture = '''{
+  "pins" : [
+    {
+      "identity" : "mobile-native-ios",
+      "kind" : "remoteSourceControl",
+      "location" : "https://github.com/iTwin/mobile-native-ios",
+      "state" : {
+        "revision" : "0123456789abcdef0123456789abcdef01234567",
+        "version" : "4.1.1"
+      }
+    },
+    {
+      "identity" : "mobile-sdk-ios",
+      "kind" : "remoteSourceControl",
+      "location" : "https://github.com/iTwin/mobile-sdk-ios",
+      "state" : {
+        "revision" : "89abcdef0123456789abcdef0123456789abcdef",
+        "version" : "0.22.1"
+      }
+    },
+    {
+      "identity" : "promisekit",
+      "kind" : "remoteSourceControl",
+      "location" : "https://github.com/mxcl/PromiseKit",
+      "state" : {
+        "revision" : "8a98e31a03854f8665d12ca2f3f1e6de6dc96a5b",
+        "version" : "6.18.1"
+      }
+    }
+  ],
+  "version" : 2
+}
+'''
+
+git_env = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='Test',
+    GIT_AUTHOR_EMAIL='test@example.com',
+    GIT_COMMITTER_NAME='Test',
+    GIT_COMMITTER_EMAIL='test@example.com',
+    GIT_CONFIG_GLOBAL=os.devnull,
+    GIT_CONFIG_NOSYSTEM='1',
+)
+
+def git(dir, *args):
+    return subprocess.run(['git'] + list(args), cwd=dir, env=git_env, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+
+# Creates a git repo in dir with a tagged commit for each of the given tags (in order), each one
+# followed by num_untagged untagged commits.
+def create_tagged_repo(dir, tags, num_untagged = 0):
+    os.makedirs(dir, exist_ok=True)
+    git(dir, 'init', '-q', '-b', newVersion.git_branch)
+    for tag in tags:
+        for i in range(num_untagged + 1):
+            with open(os.path.join(dir, 'version.txt'), 'w', encoding='UTF-8') as file:
+                file.write(f'{tag} {i}\n')
+            git(dir, 'add', 'version.txt')
+            git(dir, 'commit', '-q', '-m', f'Release {tag}' if i == 0 else f'Change {i} after {tag}')
+            if i == 0:
+                git(dir, 'tag', tag)
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_dir.cleanup)
+        self.dir = temporary_dir.name
+
+    def write(self, name, content):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'w', encoding='UTF-8', newline='') as file:
+            file.write(content)
+        return filename
+
+    def read(self, filename):
+        with open(filename, encoding='UTF-8', newline='') as file:
+            return file.read()
+
+class PackageJsonTests(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved_latest_versions = dict(newVersion.latest_versions)
+        self.addCleanup(self.restore_latest_versions)
+        # Fill in the latest versions so that no registry lookups are needed.
+        for (package, prefix) in newVersion.get_itwin_non_core_version_keys():
+            newVersion.latest_versions[f'{package}@{prefix}'] = f'{prefix}.5.0'
+        self.args = argparse.Namespace(new_mobile='0.22.2', new_itwin='4.1.4', current_mobile='0.22.2')
+
+    def restore_latest_versions(self):
+        newVersion.latest_versions.clear()
+        newVersion.latest_versions.update(self.saved_latest_versions)
+
+    def test_matches_replace_all(self):
+        filename = self.write('package.json', package_json_fixture)
+        num_replaced = newVersion.replace_all(filename, newVersion.get_package_json_tuples(self.args))
+        expected = self.read(filename)
+        versions = newVersion.get_package_json_versions(self.args)
+        (content, num_found) = newVersion.update_package_json_content(package_json_fixture, self.args.new_mobile, self.args.new_itwin, versions)
+        self.assertEqual(content, expected)
+        self.assertEqual(num_found, num_replaced)
+
+    def test_updates_versions(self):
+        versions = newVersion.get_package_json_versions(self.args)
+        (content, _) = newVersion.update_package_json_content(package_json_fixture, self.args.new_mobile, self.args.new_itwin, versions)
+        self.assertIn('"version": "0.22.2"', content)
+        self.assertIn('"@itwin/appui-react": "4.5.0"', content)
+        self.assertIn('"@itwin/core-frontend": "4.1.4"', content)
+        self.assertIn('"@itwin/build-tools": "4.1.4"', content)
+        self.assertIn('"@itwin/mobile-sdk-core": "0.22.2"', content)
+        self.assertIn('"@itwin/eslint-plugin": "4.0.0-dev.48"', content)
+        self.assertIn('"react": "^17.0.2"', content)
+
+    def test_invalid_json(self):
+        with self.assertRaises(ValueError):
+            newVersion.update_package_json_content('{"version": "0.22.1",', '0.22.2', '4.1.4', {})
+
+# The line-based update that modify_package_resolved did before it parsed the JSON, kept as the
+# reference for update_package_resolved_content.
+def update_package_resolved_lines(content, args):
+    package = None
+    lines = []
+    for line in content.splitlines(True):
+        match = re.search('"package"\\s*: "(.*)"', line)
+        if match and len(match.groups()) == 1:
+            package = match.group(1)
+        else:
+            match = re.search('"identity"\\s*:\\s*"(.*)"', line)
+            if match and len(match.groups()) == 1:
+                package = match.group(1)
+        if package == 'itwin-mobile-native' or package == 'mobile-native-ios':
+            line = re.sub('("version"\\s*:\\s*)"[0-9].*"', '\\1"' + args.new_add_on + '"', line)
+            if hasattr(args, 'new_add_on_commit_id') and args.new_add_on_commit_id:
+                line = re.sub('("revision"\\s*:\\s*)"[0-9A-Fa-f]*"', '\\1"' + args.new_add_on_commit_id + '"', line)
+        elif (package == 'itwin-mobile-sdk' or package == 'mobile-sdk-ios') and not newVersion.skip_commit_id(args):
+            line = re.sub('("version"\\s*:\\s*)"[0-9].*"', '\\1"' + args.new_mobile + '"', line)
+            if hasattr(args, 'new_commit_id') and args.new_commit_id:
+                line = re.sub('("revision"\\s*:\\s*)"[0-9A-Fa-f]*"', '\\1"' + args.new_commit_id + '"', line)
+        lines.append(line)
+    return ''.join(lines)
+
+class PackageResolvedTests(unittest.TestCase):
+    def get_args(self, **kwargs):
+        args = argparse.Namespace(
+            new_mobile='0.22.2',
+            new_commit_id='fedcba9876543210fedcba9876543210fedcba98',
+            new_add_on='4.1.4',
+            new_add_on_commit_id='76543210fedcba9876543210fedcba9876543210',
+        )
+        for (name, value) in kwargs.items():
+            setattr(args, name, value)
+        return args
+
+    def check_matches_lines(self, content, args):
+        (updated, _) = newVersion.update_package_resolved_content(content, newVersion.get_package_resolved_pins(args))
+        self.assertEqual(updated, update_package_resolved_lines(content, args))
+        return updated
+
+    def test_v1_matches_lines(self):
+        updated = self.check_matches_lines(package_resolved_v1_fixture, self.get_args())
+        self.assertIn('"version": "4.1.4"', updated)
+        self.assertIn('"version": "0.22.2"', updated)
+        self.assertIn('"version": "6.18.1"', updated)
+
+    def test_v2_matches_lines(self):
+        updated = self.check_matches_lines(package_resolved_v2_fixture, self.get_args())
+        self.assertIn('"revision" : "76543210fedcba9876543210fedcba9876543210"', updated)
+        self.assertIn('"revision" : "fedcba9876543210fedcba9876543210fedcba98"', updated)
+        self.assertIn('"revision" : "8a98e31a03854f8665d12ca2f3f1e6de6dc96a5b"', updated)
+
+    def test_without_commit_ids(self):
+        for fixture in [package_resolved_v1_fixture, package_resolved_v2_fixture]:
+            self.check_matches_lines(fixture, self.get_args(new_commit_id=None, new_add_on_commit_id=None))
+
+    def test_skip_commit_id(self):
+        for fixture in [package_resolved_v1_fixture, package_resolved_v2_fixture]:
+            updated = self.check_matches_lines(fixture, self.get_args(skip_commit_id=True))
+            self.assertIn('0.22.1', updated)
+
+    def test_no_pins(self):
+        with self.assertRaises(ValueError):
+            newVersion.update_package_resolved_content('{"version": 2}', {})
+
+class TaskGraphTests(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def task(self, name, error = None):
+        def run():
+            self.record('start ' + name)
+            if error is not None:
+                raise error
+            self.record('end ' + name)
+        return run
+
+    def test_dependency_order(self):
+        for max_workers in [1, 4]:
+            self.events = []
+            graph = newVersion.TaskGraph()
+            a = graph.add('a', self.task('a'))
+            b = graph.add('b', self.task('b'), [a])
+            c = graph.add('c', self.task('c'), [a])
+            graph.add('d', self.task('d'), [b, c])
+            graph.run(max_workers)
+            self.assertEqual(len(self.events), 8)
+            for (dependency, name) in [('a', 'b'), ('a', 'c'), ('b', 'd'), ('c', 'd')]:
+                self.assertLess(self.events.index('end ' + dependency), self.events.index('start ' + name))
+
+    def test_unknown_dependency(self):
+        graph = newVersion.TaskGraph()
+        with self.assertRaises(Exception):
+            graph.add('a', self.task('a'), ['b'])
+
+    def test_duplicate_task(self):
+        graph = newVersion.TaskGraph()
+        graph.add('a', self.task('a'))
+        with self.assertRaises(Exception):
+            graph.add('a', self.task('a'))
+
+    def test_failure_propagation(self):
+        error = RuntimeError('a failed')
+        graph = newVersion.TaskGraph()
+        a = graph.add('a', self.task('a', error))
+        graph.add('b', self.task('b'), [a])
+        graph.add('c', self.task('c'))
+        with self.assertRaises(RuntimeError) as context:
+            graph.run(1)
+        self.assertIs(context.exception, error)
+        self.assertNotIn('start b', self.events)
+
+    def test_no_new_tasks_after_failure(self):
+        # b is running when a fails; it is allowed to finish, but c, which only depends on b, is
+        # never started.
+        a_may_fail = threading.Event()
+        b_may_finish = threading.Event()
+
+        def a():
+            a_may_fail.wait(5)
+            raise RuntimeError('a failed')
+
+        def b():
+            self.record('start b')
+            a_may_fail.set()
+            b_may_finish.wait(5)
+            self.record('end b')
+
+        graph = newVersion.TaskGraph()
+        graph.add('a', a)
+        graph.add('b', b)
+        graph.add('c', self.task('c'), ['b'])
+        finish_b = threading.Timer(0.1, b_may_finish.set)
+        finish_b.start()
+        try:
+            with self.assertRaises(RuntimeError):
+                graph.run(2)
+        finally:
+            finish_b.cancel()
+        self.assertEqual(self.events, ['start b', 'end b'])
+
+class StepJournalTests(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        saved_touched_paths = set(newVersion.touched_paths)
+        self.addCleanup(self.restore_touched_paths, saved_touched_paths)
+        self.filename = os.path.join(self.dir, 'journal.json')
+        self.runs = []
+
+    def restore_touched_paths(self, saved_touched_paths):
+        newVersion.touched_paths.clear()
+        newVersion.touched_paths.update(saved_touched_paths)
+
+    def task(self, name, error = None):
+        def run():
+            self.runs.append(name)
+            if error is not None:
+                raise error
+        return run
+
+    def run_graph(self, journal, fail_b, verify_a = None):
+        graph = newVersion.TaskGraph(journal)
+        a = graph.add('a', self.task('a'), verify=verify_a)
+        b = graph.add('b', self.task('b', RuntimeError('b failed') if fail_b else None), [a])
+        graph.add('c', self.task('c'), [b])
+        graph.run(1)
+
+    def test_resume_after_failure(self):
+        journal = newVersion.StepJournal(self.filename, 'stage')
+        journal.record_inputs(argparse.Namespace(new_mobile='0.22.2', new_itwin='4.1.4'))
+        with self.assertRaises(RuntimeError):
+            self.run_graph(journal, True)
+        self.assertEqual(self.runs, ['a', 'b'])
+
+        resumed = newVersion.StepJournal(self.filename, 'stage')
+        self.assertEqual(resumed.completed, ['a'])
+        self.assertEqual(resumed.inputs, {'new_mobile': '0.22.2', 'new_itwin': '4.1.4'})
+        self.runs = []
+        self.run_graph(resumed, False)
+        self.assertEqual(self.runs, ['b', 'c'])
+        resumed.finish()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_resume_verifies_completed_steps(self):
+        journal = newVersion.StepJournal(self.filename, 'stage')
+        with self.assertRaises(RuntimeError):
+            self.run_graph(journal, True)
+        self.runs = []
+        self.run_graph(newVersion.StepJournal(self.filename, 'stage'), False, lambda: False)
+        self.assertEqual(self.runs, ['a', 'b', 'c'])
+
+    def test_restart_and_other_stage(self):
+        journal = newVersion.StepJournal(self.filename, 'stage')
+        journal.record_inputs(argparse.Namespace(new_mobile='0.22.2'))
+        journal.mark_completed('a')
+        for resumed in [newVersion.StepJournal(self.filename, 'stage', True), newVersion.StepJournal(self.filename, 'other')]:
+            self.assertEqual(resumed.inputs, {})
+            self.assertEqual(resumed.completed, [])
+
+    def test_restore_inputs(self):
+        journal = newVersion.StepJournal(self.filename, 'stage')
+        journal.record_inputs(argparse.Namespace(new_mobile='0.22.2', new_itwin='4.1.4'))
+        resumed = newVersion.StepJournal(self.filename, 'stage')
+        args = argparse.Namespace(new_mobile='0.22.2', new_itwin=None)
+        resumed.restore_inputs(args)
+        self.assertEqual(args.new_itwin, '4.1.4')
+        with self.assertRaises(Exception):
+            resumed.restore_inputs(argparse.Namespace(new_mobile='0.22.3'))
+
+    def test_run_stage_resumes(self):
+        saved_sdk_dirs = getattr(newVersion, 'sdk_dirs', None)
+        newVersion.sdk_dirs = argparse.Namespace(parent_dir=self.dir)
+        self.addCleanup(setattr, newVersion, 'sdk_dirs', saved_sdk_dirs)
+        resolved = []
+        stale_checks = []
+        fail_b = [True]
+
+        def get_stale_reason(inputs):
+            stale_checks.append(inputs)
+            return None
+
+        def resolve():
+            resolved.append(True)
+            args.new_mobile = '0.22.2'
+
+        def build_graph(graph):
+            a = graph.add('a', self.task('a'))
+            graph.add('b', lambda: self.task('b', RuntimeError('b failed') if fail_b[0] else None)(), [a])
+
+        args = argparse.Namespace(restart=False, new_mobile=None)
+        with self.assertRaises(RuntimeError):
+            newVersion.run_stage(args, 'stage', resolve, build_graph, get_stale_reason)
+        filename = newVersion.get_journal_filename('stage')
+        self.assertTrue(os.path.exists(filename))
+
+        fail_b[0] = False
+        self.runs = []
+        args = argparse.Namespace(restart=False, new_mobile=None)
+        newVersion.run_stage(args, 'stage', resolve, build_graph, get_stale_reason)
+        self.assertEqual(resolved, [True])
+        self.assertEqual(stale_checks, [{'new_mobile': '0.22.2'}])
+        self.assertEqual(args.new_mobile, '0.22.2')
+        self.assertEqual(self.runs, ['b'])
+        self.assertFalse(os.path.exists(filename))
+
+    def test_run_stage_rejects_stale_journal(self):
+        saved_sdk_dirs = getattr(newVersion, 'sdk_dirs', None)
+        newVersion.sdk_dirs = argparse.Namespace(parent_dir=self.dir)
+        self.addCleanup(setattr, newVersion, 'sdk_dirs', saved_sdk_dirs)
+        journal = newVersion.StepJournal(newVersion.get_journal_filename('stage'), 'stage')
+        journal.record_inputs(argparse.Namespace(new_mobile='0.22.2'))
+        journal.mark_completed('a')
+        args = argparse.Namespace(restart=False, new_mobile=None)
+
+        def build_graph(graph):
+            graph.add('b', self.task('b'))
+
+        with self.assertRaises(Exception) as context:
+            newVersion.run_stage(args, 'stage', lambda: None, build_graph, lambda inputs: '0.22.2 has already been tagged')
+        self.assertIn('out of date', str(context.exception))
+        self.assertEqual(self.runs, [])
+        self.assertIsNone(args.new_mobile)
+
+    def test_stale_journal_reasons(self):
+        saved_sdk_dirs = getattr(newVersion, 'sdk_dirs', None)
+        sdk_ios = os.path.join(self.dir, 'mobile-sdk-ios')
+        samples = os.path.join(self.dir, 'mobile-samples')
+        newVersion.sdk_dirs = argparse.Namespace(parent_dir=self.dir, sdk_ios=sdk_ios, samples=samples)
+        self.addCleanup(setattr, newVersion, 'sdk_dirs', saved_sdk_dirs)
+        base = newVersion.mobile_base_version
+        create_tagged_repo(sdk_ios, [base + '0', base + '1'])
+        current = {'current_mobile': base + '1', 'new_mobile': base + '2'}
+        self.assertIsNone(newVersion.get_stale_change_journal_reason(current))
+        old = {'current_mobile': base + '0', 'new_mobile': base + '1'}
+        self.assertIn('already been tagged', newVersion.get_stale_change_journal_reason(old))
+        self.assertIn('last release', newVersion.get_stale_change_journal_reason({'current_mobile': base + '0', 'new_mobile': base + '5'}))
+        older = {'current_mobile': base + '0', 'new_mobile': base + '0'}
+        self.assertIn('last release', newVersion.get_stale_release_journal_reason(older))
+
+class BranchIsPushedTests(TemporaryDirectoryTestCase):
+    def test_push_by_url(self):
+        remote = os.path.join(self.dir, 'remote.git')
+        dir = os.path.join(self.dir, 'mobile-sdk-ios')
+        git(self.dir, 'init', '-q', '--bare', remote)
+        create_tagged_repo(dir, ['0.22.0'])
+        saved_get_repo = newVersion.get_repo
+        newVersion.get_repo = lambda dir: remote
+        self.addCleanup(setattr, newVersion, 'get_repo', saved_get_repo)
+        self.assertFalse(newVersion.branch_is_pushed(dir))
+        # Like push_dir, push to the URL, which leaves no remote-tracking branch to compare with.
+        git(dir, 'push', '-q', remote, newVersion.git_branch)
+        self.assertTrue(newVersion.branch_is_pushed(dir))
+        git(dir, 'commit', '-q', '--allow-empty', '-m', 'Unpushed')
+        self.assertFalse(newVersion.branch_is_pushed(dir))
+
+class BootstrapTests(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        saved_sdk_dirs = getattr(newVersion, 'sdk_dirs', None)
+        self.addCleanup(setattr, newVersion, 'sdk_dirs', saved_sdk_dirs)
+        newVersion.sdk_dirs = newVersion.MobileSdkDirs(argparse.Namespace(parent_dir=os.path.join(self.dir, 'parent')))
+        self.base_url = os.path.join(self.dir, 'base')
+
+    # Creates a bare <repository>.git in base_url for each of the SDK dirs, with a tagged commit
+    # for each of tags, each followed by three untagged commits.
+    def create_repos(self, tags):
+        for dir in newVersion.sdk_dirs:
+            source = os.path.join(self.dir, 'source', os.path.basename(dir))
+            create_tagged_repo(source, tags, 3)
+            git(self.dir, 'clone', '-q', '--bare', source, os.path.join(self.base_url, os.path.basename(dir) + '.git'))
+
+    def bootstrap(self, depth = None):
+        newVersion.bootstrap_command(argparse.Namespace(base_url=self.base_url, depth=depth, reference=None))
+
+    def check_dirs(self, tags, num_commits):
+        for dir in newVersion.sdk_dirs:
+            self.assertEqual(newVersion.get_current_branch(dir), newVersion.git_branch)
+            self.assertEqual(sorted(git(dir, 'tag').split()), sorted(tags))
+            self.assertEqual(int(git(dir, 'rev-list', '--count', 'HEAD')), num_commits)
+
+    def test_partial_clone(self):
+        tags = [f'{newVersion.mobile_base_version}{patch}' for patch in range(6)]
+        self.create_repos(tags)
+        self.bootstrap()
+        self.check_dirs(tags, 24)
+        self.assertEqual(newVersion.get_last_release(), tags[-1])
+        # A second bootstrap updates the existing clones.
+        self.bootstrap()
+        self.check_dirs(tags, 24)
+
+    def test_shallow_clone(self):
+        tags = [f'{newVersion.mobile_base_version}{patch}' for patch in range(6)]
+        self.create_repos(tags)
+        self.bootstrap(2)
+        self.check_dirs(tags, 2)
+        self.assertEqual(git(newVersion.sdk_dirs.sdk_ios, 'rev-parse', '--is-shallow-repository').strip(), 'true')
+        self.assertEqual(newVersion.get_last_release(), tags[-1])
+
+    def test_shallow_clone_first_patch(self):
+        tags = [f'{newVersion.mobile_base_version}0']
+        self.create_repos(tags)
+        self.bootstrap(2)
+        self.check_dirs(tags, 2)
+        self.assertEqual(newVersion.get_last_release(), tags[0])
+
+# The packuments served by RegistryHandler.
+registry_packuments = {
+    '@itwin/core-common': ['4.1.0', '4.9.0', '4.9.10', '4.9.2', '4.10.0', '4.9.11-dev.1'],
+    '@itwin/core-backend': ['4.9.2', '4.9.10'],
+}
+
+# A stand-in for the npm registry that serves registry_packuments, gzipped when the client accepts
+# that, and records the path and client address of each request.
+class RegistryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        package = urllib.parse.unquote(self.path.lstrip('/'))
+        self.requests.append((package, self.client_address))
+        if package not in registry_packuments:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        versions = registry_packuments[package]
+        packument = {
+            'name': package,
+            'versions': {version: {'version': version, 'dependencies': {newVersion.native_version_dependency: version + '.1'}} for version in versions},
+        }
+        body = json.dumps(packument).encode('UTF-8')
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class RegistryTests(unittest.TestCase):
+    def setUp(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RegistryHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        RegistryHandler.requests = []
+        for name in ['npm_config', 'registry_client', 'lookup_cache', 'latest_versions', 'version_indexes']:
+            self.addCleanup(setattr, newVersion, name, getattr(newVersion, name))
+        # Don't send the requests to a proxy from the environment.
+        newVersion.npm_config = {'noproxy': '127.0.0.1'}
+        newVersion.registry_client = newVersion.RegistryClient(f'http://127.0.0.1:{server.server_port}/')
+        newVersion.lookup_cache = newVersion.LookupCache()
+        newVersion.latest_versions = {}
+        newVersion.version_indexes = {}
+
+    def test_latest_version(self):
+        self.assertEqual(newVersion.get_latest_version('@itwin/core-common', '4.9'), '4.9.10')
+        self.assertEqual(newVersion.get_latest_version('@itwin/core-common', '4'), '4.10.0')
+        # Both come from one request for the packument.
+        self.assertEqual([package for (package, _) in RegistryHandler.requests], ['@itwin/core-common'])
+
+    def test_latest_native_version(self):
+        self.assertEqual(newVersion.get_latest_native_version('4.9.10'), '4.9.10.1')
+        with self.assertRaises(Exception):
+            newVersion.get_latest_native_version('4.9.11')
+
+    def test_not_found(self):
+        with self.assertRaises(Exception) as context:
+            newVersion.get_latest_version('@itwin/not-published', '1')
+        self.assertIn('not found', str(context.exception))
+
+    def test_reuses_connection(self):
+        for package in ['@itwin/core-common', '@itwin/core-backend']:
+            newVersion.registry_client.get_packument(package)
+        with self.assertRaises(Exception):
+            newVersion.registry_client.get_packument('@itwin/not-published')
+        self.assertEqual(len(RegistryHandler.requests), 3)
+        self.assertEqual(len({address for (_, address) in RegistryHandler.requests}), 1)
+
+class VersionTests(unittest.TestCase):
+    def test_ordering(self):
+        # The precedence example from the semver spec, plus numeric identifiers that only sort
+        # correctly when compared as numbers.
+        ordered = [
+            '1.0.0-alpha',
+            '1.0.0-alpha.1',
+            '1.0.0-alpha.beta',
+            '1.0.0-beta',
+            '1.0.0-beta.2',
+            '1.0.0-beta.11',
+            '1.0.0-rc.1',
+            '1.0.0',
+            '1.0.1-dev.9',
+            '1.0.1-dev.10',
+            '1.0.1',
+            '1.2.0',
+            '1.10.0',
+            '2.0.0',
+        ]
+        keys = [newVersion.Version(text).key for text in ordered]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_parse(self):
+        version = newVersion.Version('v4.1.0-dev.12+build.5')
+        self.assertEqual(version.release, (4, 1, 0))
+        self.assertEqual(version.prerelease, ('dev', 12))
+        self.assertEqual(version.key, newVersion.Version('4.1.0-dev.12').key)
+        for text in ['4.1', '4.1.0.1', 'latest']:
+            with self.assertRaises(ValueError):
+                newVersion.Version(text)
+
+    def test_latest_matching_prefix(self):
+        index = newVersion.VersionIndex(['4.9.0', '4.10.0', '4.9.10', '4.9.2', '4.9.11-dev.1', '5.0.0', 'invalid'])
+        self.assertEqual(index.latest_matching_prefix('4.9'), '4.9.10')
+        self.assertEqual(index.latest_matching_prefix('4'), '4.10.0')
+        self.assertEqual(index.latest_matching_prefix('4.9.11-dev'), '4.9.11-dev.1')
+        self.assertIsNone(index.latest_matching_prefix('3'))
+
+if __name__ == '__main__':
+    unittest.main()